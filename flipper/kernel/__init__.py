@@ -18,15 +18,16 @@ in a functions docstring:
 from realalg import RealNumberField, RealAlgebraic  # noqa: F401
 
 from .bundle import Bundle  # noqa: F401
+from .cache import PersistentCache, set_persistent_cache, get_persistent_cache  # noqa: F401
 from .encoding import Encoding  # noqa: F401
 from .error import AssumptionError, ComputationError, FatalError, ApproximationError, AbortError  # noqa: F401
-from .equippedtriangulation import EquippedTriangulation  # noqa: F401
+from .equippedtriangulation import EquippedTriangulation, Classification  # noqa: F401
 from .flatstructure import FlatStructure, Vector2  # noqa: F401
 from .lamination import Lamination  # noqa: F401
 from .matrix import Matrix, id_matrix, zero_matrix, dot  # noqa: F401
-from .moves import Move, Isometry, EdgeFlip, LinearTransformation  # noqa: F401
+from .moves import Move, Isometry, EdgeFlip, Spiral, LinearTransformation  # noqa: F401
 from .permutation import Permutation  # noqa: F401
-from .splittingsequence import SplittingSequence, SplittingSequences  # noqa: F401
+from .splittingsequence import SplittingSequence, SplittingSequences, SplittingSearch  # noqa: F401
 from .triangulation import Vertex, Edge, Triangle, Triangulation, Corner, norm  # noqa: F401
 from .triangulation3 import Tetrahedron, Triangulation3  # noqa: F401
 
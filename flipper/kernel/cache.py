@@ -0,0 +1,181 @@
+
+''' A module for storing the results of expensive computations on disk.
+
+Provides one class: PersistentCache.
+
+There are also helper functions: content_key, set_persistent_cache and get_persistent_cache. '''
+
+import hashlib
+import os
+import pickle
+import sqlite3
+import time
+
+import flipper
+
+# Bump this whenever the results of a persisted method change so that stale entries are ignored.
+FORMAT_VERSION = 1
+
+class PersistentCache(object):
+    ''' This represents a content-addressed store of results held in an SQLite database.
+    
+    Results are pickled and stored under a key, typically built by content_key().
+    Once the total size of the stored results exceeds max_size bytes, the least
+    recently used entries are evicted. Several processes may share the same file as
+    each process (including forked children) opens its own connection to it.
+    
+    To avoid writing to the database on every hit, the times that entries were
+    last used are recorded in batches of access_batch. '''
+    def __init__(self, path, max_size=2**30, access_batch=100):
+        assert isinstance(max_size, flipper.IntegerType)
+        assert isinstance(access_batch, flipper.IntegerType)
+        
+        self.path = path
+        self.max_size = max_size
+        self.access_batch = access_batch
+        self.hits = 0
+        self.misses = 0
+        
+        self._connection = None
+        self._pid = None  # The process that opened self._connection.
+        self._accessed = dict()  # Maps keys to the time that they were last used, which has not been written yet.
+        self._size = 0  # An estimate of the number of bytes stored.
+    
+    @property
+    def connection(self):
+        ''' Return a connection to the database that is owned by this process.
+        
+        SQLite connections cannot be used across a fork() and so a new one is opened
+        whenever this is used in a different process to before. '''
+        
+        if self._pid != os.getpid():
+            self._connection = sqlite3.connect(self.path, timeout=60)
+            self._pid = os.getpid()
+            self._accessed = dict()
+            with self._connection:
+                self._connection.execute('CREATE TABLE IF NOT EXISTS results (key TEXT PRIMARY KEY, value BLOB, size INTEGER, accessed REAL)')
+                self._connection.execute('CREATE INDEX IF NOT EXISTS results_accessed ON results (accessed)')
+            self._size = self.size()
+        return self._connection
+    
+    def __repr__(self):
+        return str(self)
+    def __str__(self):
+        return 'PersistentCache(%r) with %d entries' % (self.path, len(self))
+    def __reduce__(self):
+        return (self.__class__, (self.path, self.max_size, self.access_batch))
+    def __len__(self):
+        return self.connection.execute('SELECT COUNT(*) FROM results').fetchone()[0]
+    def __contains__(self, key):
+        return self.connection.execute('SELECT 1 FROM results WHERE key = ?', (key,)).fetchone() is not None
+    def __getitem__(self, key):
+        row = self.connection.execute('SELECT value FROM results WHERE key = ?', (key,)).fetchone()
+        if row is None:
+            self.misses += 1
+            raise KeyError(key)
+        
+        self.hits += 1
+        self._accessed[key] = time.time()
+        if len(self._accessed) >= self.access_batch:
+            self.flush()
+        return pickle.loads(row[0])
+    def __setitem__(self, key, value):
+        data = pickle.dumps(value, protocol=pickle.HIGHEST_PROTOCOL)
+        with self.connection:
+            row = self.connection.execute('SELECT size FROM results WHERE key = ?', (key,)).fetchone()
+            self.connection.execute('INSERT OR REPLACE INTO results VALUES (?, ?, ?, ?)', (key, sqlite3.Binary(data), len(data), time.time()))
+        self._accessed.pop(key, None)
+        self._size += len(data) - (row[0] if row is not None else 0)
+        if self._size > self.max_size:
+            self.evict()
+    def __delitem__(self, key):
+        self._accessed.pop(key, None)
+        with self.connection:
+            self.connection.execute('DELETE FROM results WHERE key = ?', (key,))
+    
+    def size(self):
+        ''' Return the total number of bytes of results stored. '''
+        
+        return self.connection.execute('SELECT COALESCE(SUM(size), 0) FROM results').fetchone()[0]
+    
+    def flush(self):
+        ''' Write the times that entries were last used to the database. '''
+        
+        if self._accessed:
+            with self.connection:
+                self.connection.executemany('UPDATE results SET accessed = ? WHERE key = ?', [(accessed, key) for key, accessed in self._accessed.items()])
+            self._accessed = dict()
+    
+    def evict(self):
+        ''' Remove the least recently used results until at most max_size bytes are stored. '''
+        
+        self.flush()
+        with self.connection:
+            self._size = self.size()
+            to_delete = []
+            for key, size in self.connection.execute('SELECT key, size FROM results ORDER BY accessed, key'):
+                if self._size <= self.max_size:
+                    break
+                to_delete.append((key,))
+                self._size -= size
+            self.connection.executemany('DELETE FROM results WHERE key = ?', to_delete)
+    
+    def clear(self):
+        ''' Remove all results from this cache. '''
+        
+        self._accessed = dict()
+        with self.connection:
+            self.connection.execute('DELETE FROM results')
+        self._size = 0
+    
+    def close(self):
+        ''' Write any outstanding access times and close the underlying database. '''
+        
+        if self._pid == os.getpid():
+            self.flush()
+            self._connection.close()
+        self._connection = None
+        self._pid = None
+
+def canonical(item):
+    ''' Return a hashable description of item that only depends on its content. '''
+    
+    if isinstance(item, flipper.kernel.Encoding):
+        # Note that we cannot use the iso_sig of the source triangulation as it
+        # forgets the labels of the edges, which the results depend on.
+        return ('Encoding', canonical(item.source_triangulation), canonical(item.package()))
+    elif isinstance(item, flipper.kernel.LinearTransformation):
+        return ('LinearTransformation', canonical(item.target_triangulation), canonical(item.geometric.rows), canonical(item.algebraic.rows))
+    elif isinstance(item, flipper.kernel.Triangulation):
+        return ('Triangulation', canonical(item.package()))
+    elif isinstance(item, dict):
+        return tuple(sorted((canonical(key), canonical(value)) for key, value in item.items()))
+    elif isinstance(item, (list, tuple)):
+        return tuple(canonical(x) for x in item)
+    elif item is None or isinstance(item, (bool, flipper.IntegerType, str)):
+        return item
+    else:
+        raise TypeError('Cannot build a content key from %s.' % type(item).__name__)
+
+def content_key(*items):
+    ''' Return a key, suitable for a PersistentCache, that only depends on the content of the given items. '''
+    
+    return hashlib.sha256(repr((FORMAT_VERSION,) + canonical(items)).encode('utf-8')).hexdigest()
+
+PERSISTENT_CACHE = None
+
+def set_persistent_cache(cache):
+    ''' Use the given PersistentCache, or the one at the given path, to store results.
+    
+    Passing None disables the persistent cache, which is the default. '''
+    
+    global PERSISTENT_CACHE  # pylint: disable=global-statement
+    if cache is not None and not isinstance(cache, PersistentCache):
+        cache = PersistentCache(cache)
+    PERSISTENT_CACHE = cache
+
+def get_persistent_cache():
+    ''' Return the PersistentCache currently in use, or None if there is not one. '''
+    
+    return PERSISTENT_CACHE
+
@@ -1,29 +1,119 @@
 
 ''' A module for decorators. '''
 
+from collections import OrderedDict
+from functools import wraps
 import inspect
+try:
+    from inspect import getfullargspec as getargspec
+except ImportError:  # Python 2.
+    from inspect import getargspec
 from decorator import decorator
 
+import flipper
+
+# The number of results of each method that memoize keeps for each object.
+DEFAULT_MAXSIZE = 128
+
+def memoize(function=None, maxsize=DEFAULT_MAXSIZE):
+    ''' A decorator that memoizes a function.
+    
+    This can be used either as @memoize or as @memoize(maxsize=...). If function is a
+    method then its results, and any AssumptionErrors that it raises, are stored in
+    self._cache, otherwise they are stored on the function itself. At most maxsize
+    results are kept, discarding the least recently used first, or all of them are
+    kept if maxsize is None. The number of hits and misses are recorded in the
+    hits and misses attributes of the decorated function. '''
+    
+    if function is None:
+        return lambda function: memoize(function, maxsize)
+    
+    # Do the expensive inspection once, rather than on every call.
+    spec = getargspec(function)
+    names = list(spec.args)
+    defaults = tuple(spec.defaults or ())
+    num_required = len(names) - len(defaults)
+    defaults = (None,) * num_required + defaults
+    is_method = bool(names) and names[0] == 'self'  # If not, we store the cache in the function itself.
+    varargs, varkw, kwonlyargs = spec[1], spec[2], getattr(spec, 'kwonlyargs', [])  # The name of varkw differs between the versions of ArgSpec.
+    simple = varargs is None and varkw is None and not kwonlyargs
+    cache_name = '__%s__' % function.__name__
+    
+    @wraps(function)
+    def memoized(*args, **kwargs):
+        ''' The memoized version of function. '''
+        
+        if simple and not kwargs and num_required <= len(args) <= len(names):
+            inputs = args + defaults[len(args):]
+        else:
+            arguments = inspect.getcallargs(function, *args, **kwargs)  # pylint: disable=deprecated-method
+            inputs = tuple(arguments[name] for name in names)
+            if varargs is not None:
+                inputs += (arguments[varargs],)
+            inputs += tuple(arguments[name] for name in kwonlyargs)
+            if varkw is not None:
+                inputs += (tuple(sorted(arguments[varkw].items())),)
+        owner, key = (inputs[0], inputs[1:]) if is_method else (memoized, inputs)
+        
+        if not hasattr(owner, '_cache'):
+            owner._cache = dict()
+        if cache_name not in owner._cache:
+            owner._cache[cache_name] = OrderedDict()
+        cache = owner._cache[cache_name]
+        
+        try:
+            result = cache.pop(key)  # Putting it back below marks it as the most recently used.
+        except KeyError:
+            memoized.misses += 1
+            try:
+                result = function(*args, **kwargs)
+            except flipper.AssumptionError as error:  # Other errors, such as timeouts, may not happen next time.
+                result = error
+            cache[key] = result
+            if maxsize is not None and len(cache) > maxsize:
+                cache.popitem(last=False)
+        except TypeError:  # Unhashable arguments, so we can't cache this call.
+            return function(*args, **kwargs)
+        else:
+            memoized.hits += 1
+            cache[key] = result
+        
+        if isinstance(result, flipper.AssumptionError):
+            raise result
+        else:
+            return result
+    
+    memoized.hits = 0
+    memoized.misses = 0
+    memoized.maxsize = maxsize
+    return memoized
+
 @decorator
-def memoize(function, *args, **kwargs):
-    ''' A decorator that memoizes a function. '''
+def persist(function, self, *args, **kwargs):
+    ''' A decorator that stores the results of a method in the persistent cache, when one is in use.
     
-    inputs = inspect.getcallargs(function, *args, **kwargs)  # pylint: disable=deprecated-method
-    self = inputs.pop('self', function)  # We test whether function is a method by looking for a `self` argument. If not we store the cache in the function itself.
+    Results are keyed on the content of self and the arguments, see flipper.kernel.cache.content_key,
+    and so must depend on nothing else. As with memoize, AssumptionErrors are stored and re-raised. '''
     
-    if not hasattr(self, '_cache'):
-        self._cache = dict()
-    key = (function.__name__, frozenset(inputs.items()))
-    if key not in self._cache:
+    cache = flipper.kernel.cache.get_persistent_cache()
+    if cache is None:
+        return function(self, *args, **kwargs)
+    
+    try:
+        key = flipper.kernel.cache.content_key(function.__name__, self, args, kwargs)
+    except TypeError:  # We don't know how to describe the arguments.
+        return function(self, *args, **kwargs)
+    
+    try:
+        result = cache[key]
+    except KeyError:
         try:
-            self._cache[key] = function(*args, **kwargs)
-        except Exception as error:  # pylint: disable=broad-except
-            if isinstance(error, KeyboardInterrupt):
-                raise
-            self._cache[key] = error
-    
-    result = self._cache[key]
-    if isinstance(result, Exception):
+            result = function(self, *args, **kwargs)
+        except flipper.AssumptionError as error:
+            result = error
+        cache[key] = result
+    
+    if isinstance(result, flipper.AssumptionError):
         raise result
     else:
         return result
@@ -3,10 +3,10 @@
 
 Provides one class: Encoding. '''
 
-from itertools import product
+import numpy as np
 
 import flipper
-from flipper.kernel.decorators import memoize  # Special import needed for decorating.
+from flipper.kernel.decorators import memoize, persist  # Special import needed for decorating.
 
 NT_TYPE_PERIODIC = 'Periodic'
 NT_TYPE_REDUCIBLE = 'Reducible'  # Strictly this  means "reducible and not periodic".
@@ -28,16 +28,79 @@ class Encoding(object):
         #  assert all(x.source_triangulation == y.target_triangulation for x, y in zip(sequence, sequence[1:]))
         # However this makes composing Encodings a quadratic time algorithm!
         
-        self.sequence = sequence
+        self._sequence = sequence
+        self._parts = None  # The Encodings that this is the composition of, see self.from_parts().
+        self._package = None  # The package of self.sequence once its moves have been released, see self.compress().
+        self._length = len(sequence)
+        self._flip_length = None
         
-        self.source_triangulation = self.sequence[-1].source_triangulation
-        self.target_triangulation = self.sequence[0].target_triangulation
+        self.source_triangulation = sequence[-1].source_triangulation
+        self.target_triangulation = sequence[0].target_triangulation
         self.zeta = self.source_triangulation.zeta
         
         self._cache = {'name': ''} if _cache is None else _cache  # For caching hard to compute results.
+        self._program = None  # The compiled form of self.sequence, see self.compile().
+    
+    @classmethod
+    def from_parts(cls, parts, _cache=None):
+        ''' Return the composition of the given Encodings, which act from right to left.
+        
+        This does not build the sequence of the composition until it is needed and so
+        takes time proportional to len(parts). As parts may themselves be built in this
+        way, this allows long compositions to be built up without repeatedly copying
+        the sequences of their parts. '''
+        
+        assert isinstance(parts, (list, tuple))
+        assert parts
+        assert all(isinstance(part, Encoding) for part in parts)
+        
+        self = cls.__new__(cls)
+        self._sequence = None
+        self._parts = tuple(parts)
+        self._package = None
+        self._length = sum(len(part) for part in parts)
+        self._flip_length = sum(part.flip_length() for part in parts)
+        
+        self.source_triangulation = parts[-1].source_triangulation
+        self.target_triangulation = parts[0].target_triangulation
+        self.zeta = self.source_triangulation.zeta
+        
+        self._cache = {'name': ''} if _cache is None else _cache
+        self._program = None
+        return self
+    
+    def leaves(self):
+        ''' Return the list of Encodings, each built from a sequence of moves, that this is the composition of. '''
+        
+        # We do this iteratively as compositions can be very deep.
+        leaves = []
+        stack = [self]
+        while stack:
+            encoding = stack.pop()
+            if encoding._parts is None:  # pylint: disable=protected-access
+                leaves.append(encoding)
+            else:
+                stack.extend(reversed(encoding._parts))  # pylint: disable=protected-access
+        
+        return leaves
+    
+    @property
+    def sequence(self):
+        ''' The list of moves of this encoding, which act from right to left. '''
+        
+        if self._sequence is None:
+            if self._package is not None:
+                # The moves were released by self.compress(), so rebuild them but do not keep them.
+                return self.source_triangulation.encode(self._package).sequence
+            self._sequence = [item for leaf in self.leaves() for item in leaf.sequence]
+            self._parts = None
+        
+        return self._sequence
     
     def without_cache(self):
         ''' Return this Encoding but with an empty cache. '''
+        if self._parts is not None:
+            return Encoding.from_parts(self._parts, _cache={'name': self._cache['name']})
         return Encoding(self.sequence, _cache={'name': self._cache['name']})
     
     def is_mapping_class(self):
@@ -54,16 +117,24 @@ class Encoding(object):
     def __iter__(self):
         return iter(self.sequence)
     def __len__(self):
-        return len(self.sequence)
+        return self._length
     def package(self):
         ''' Return a small amount of info that self.source_triangulation can use to reconstruct this triangulation. '''
-        return [item.package() for item in self]
+        if self._package is not None:
+            return list(self._package)
+        elif self._parts is not None:
+            return [data for leaf in self.leaves() for data in leaf.package()]
+        else:
+            return [item.package() for item in self]
     def __reduce__(self):
         return (create_encoding, (self.source_triangulation, self.package(), self._cache))
     def flip_length(self):
         ''' Return the number of flips needed to realise this sequence. '''
         
-        return sum(item.flip_length for item in self)
+        if self._flip_length is None:
+            self._flip_length = sum(item.flip_length for item in self)
+        
+        return self._flip_length
     def __getitem__(self, value):
         if isinstance(value, slice):
             # It turns out that handling all slices correctly is really hard.
@@ -86,6 +157,57 @@ class Encoding(object):
         else:
             return NotImplemented
     
+    def compile(self):
+        ''' Return the program of instructions that realises the action of this encoding on weights.
+        
+        This is the concatenation of item.compile() for each item of this encoding, in the
+        order in which they act. It is computed once and then reused by self.__call__. '''
+        
+        if self._program is None:
+            if self._parts is not None:
+                # Reuse the programs of the parts, which may be repeated many times, as in a power.
+                self._program = tuple(instruction for leaf in reversed(self.leaves()) for instruction in leaf.compile())
+            else:
+                self._program = tuple(instruction for item in reversed(self.sequence) for instruction in item.compile())
+        
+        return self._program
+    
+    def compress(self):
+        ''' Release the moves of this encoding, along with the intermediate triangulations that they pin.
+        
+        Only self.package(), which is a few integers per move, and the compiled program are
+        kept. The moves are rebuilt from self.source_triangulation whenever self.sequence is
+        needed but are not kept afterwards, so this trades time for memory. Applying this
+        encoding to laminations only uses the compiled program and so is unaffected. '''
+        
+        if self._package is not None: return  # Already compressed.
+        
+        self.compile()
+        self.flip_length()
+        self._package = self.package()
+        self._sequence = None
+        self._parts = None
+    
+    def apply_many(self, laminations):
+        ''' Return the list of images of the given laminations under this encoding.
+        
+        This is equivalent to [self(lamination) for lamination in laminations] but
+        all of the laminations are pushed through this encoding in a single pass.
+        
+        Each lamination must be defined on self.source_triangulation. '''
+        
+        laminations = list(laminations)
+        if not laminations: return []
+        if any(self.source_triangulation != lamination.triangulation for lamination in laminations):
+            raise ValueError('Cannot apply an Encoding to a Lamination on a triangulation other than source_triangulation.')
+        
+        # Transpose so that there is one row per edge.
+        geometric = [list(row) for row in zip(*[lamination.geometric for lamination in laminations])]
+        algebraic = [list(row) for row in zip(*[lamination.algebraic for lamination in laminations])]
+        geometric, algebraic = flipper.kernel.moves.execute_many(self.compile(), geometric, algebraic)
+        
+        return [self.target_triangulation.lamination(list(g), list(a), remove_peripheral=False) for g, a in zip(zip(*geometric), zip(*algebraic))]
+    
     def identify(self):
         ''' Return a tuple of integers which uniquely determines this map.
         
@@ -94,7 +216,7 @@ class Encoding(object):
         (assuming we know source_triangulation and target_triangulation)
         by Alexanders trick. '''
         if '__identify__' not in self._cache:
-            images = [self(curve) for curve in self.source_triangulation.key_curves()]
+            images = self.apply_many(self.source_triangulation.key_curves())
             self._cache['__identify__'] = tuple(entry for curve in images for vector in [curve.geometric, curve.algebraic] for entry in vector)
         
         return self._cache['__identify__']
@@ -121,7 +243,8 @@ class Encoding(object):
             if self.source_triangulation != other.source_triangulation or self.target_triangulation != other.target_triangulation:
                 raise ValueError('Cannot compare Encodings between different triangulations.')
             
-            return all(self(curve).is_homologous_to(other(curve)) for curve in self.source_triangulation.key_curves())
+            curves = self.source_triangulation.key_curves()
+            return all(image.is_homologous_to(other_image) for image, other_image in zip(self.apply_many(curves), other.apply_many(curves)))
         else:
             return NotImplemented
     
@@ -130,12 +253,7 @@ class Encoding(object):
             if self.source_triangulation != other.triangulation:
                 raise ValueError('Cannot apply an Encoding to a Lamination on a triangulation other than source_triangulation.')
             
-            geometric = other.geometric
-            algebraic = other.algebraic
-            
-            for item in reversed(self.sequence):
-                geometric = item.apply_geometric(geometric)
-                algebraic = item.apply_algebraic(algebraic)
+            geometric, algebraic = flipper.kernel.moves.execute(self.compile(), list(other.geometric), list(other.algebraic))
             
             return self.target_triangulation.lamination(geometric, algebraic, remove_peripheral=False)
         else:
@@ -145,7 +263,7 @@ class Encoding(object):
             if self.source_triangulation != other.target_triangulation:
                 raise ValueError('Cannot compose Encodings over different triangulations.')
             
-            return Encoding(self.sequence + other.sequence, _cache=dict() if 'name' not in self._cache or 'name' not in other._cache else {'name': self._cache['name'] + '.' + other._cache['name']})
+            return Encoding.from_parts([self, other], _cache=dict() if 'name' not in self._cache or 'name' not in other._cache else {'name': self._cache['name'] + '.' + other._cache['name']})
         else:
             return NotImplemented
     def __pow__(self, k):
@@ -154,7 +272,11 @@ class Encoding(object):
         if k == 0:
             return self.source_triangulation.id_encoding()
         elif k > 0:
-            return Encoding(self.sequence * k, _cache=dict() if 'name' not in self._cache else {'name': '(%s)^%d' % (self._cache['name'], k)})
+            # Build the power by repeated squaring so that it only has O(log(k)) parts.
+            power = self
+            for bit in bin(k)[3:]:
+                power = Encoding.from_parts([power, power] if bit == '0' else [self, power, power], _cache=dict())
+            return Encoding.from_parts([power], _cache=dict() if 'name' not in self._cache else {'name': '(%s)^%d' % (self._cache['name'], k)})
         else:
             return self.inverse()**abs(k)
     
@@ -165,6 +287,55 @@ class Encoding(object):
     def __invert__(self):
         return self.inverse()
     
+    def simplify(self):
+        ''' Return an encoding equal to this one but with possibly fewer moves.
+        
+        This cancels each EdgeFlip against an inverse EdgeFlip, even when they are
+        separated by flips of edges outside of its square as these commute with it.
+        It also composes consecutive Isometries and drops identity ones. '''
+        
+        moves = []  # The moves kept so far, in the order in which they act.
+        for move in reversed(self.sequence):
+            if isinstance(move, flipper.kernel.Isometry):
+                if moves and isinstance(moves[-1], flipper.kernel.Isometry):
+                    previous = moves.pop()
+                    label_map = dict((label, move.label_map[previous.label_map[label]]) for label in previous.source_triangulation.labels)
+                    move = flipper.kernel.Isometry(previous.source_triangulation, move.target_triangulation, label_map)
+                if move.source_triangulation != move.target_triangulation or any(move.label_map[i] != i for i in move.source_triangulation.indices):
+                    moves.append(move)
+            elif isinstance(move, flipper.kernel.EdgeFlip):
+                square = [edge.index for edge in move.square] + [move.edge_index]
+                for index in reversed(range(len(moves))):
+                    other = moves[index]
+                    if not isinstance(other, flipper.kernel.EdgeFlip):
+                        break
+                    if other.edge_label == ~move.edge_label:
+                        # The flips after other commute with move, so we cancel move and other
+                        # and then redo these flips starting from other.source_triangulation.
+                        triangulation = other.source_triangulation
+                        replayed = []
+                        for later in moves[index+1:]:
+                            if not triangulation.is_flippable(later.edge_label): break
+                            new_triangulation = triangulation.flip_edge(later.edge_label)
+                            replayed.append(flipper.kernel.EdgeFlip(triangulation, new_triangulation, later.edge_label))
+                            triangulation = new_triangulation
+                        else:
+                            if triangulation == move.target_triangulation:
+                                moves[index:] = replayed
+                                move = None
+                                break
+                    if other.edge_index in square:
+                        break
+                if move is not None:
+                    moves.append(move)
+            else:
+                moves.append(move)
+        
+        if not moves:
+            return self.source_triangulation.id_encoding()
+        
+        return Encoding(moves[::-1], _cache=dict() if 'name' not in self._cache else {'name': self._cache['name']})
+    
     def closing_isometries(self):
         ''' Return all the possible isometries from self.target_triangulation to self.source_triangulation.
         
@@ -185,14 +356,16 @@ class Encoding(object):
         # for i in range(1, self.source_triangulation.max_order + 1):
         #    if self**i == self.source_triangulation.id_encoding():
         #        return i
-        # But this is quadratic in the order so instead we do:
+        # But this is quadratic in the order so instead we do the following.
+        # The first key curve is usually enough to rule out every possible order
+        # so we try it by itself first before pushing the rest through together.
         curves = self.source_triangulation.key_curves()
         possible_orders = set(range(1, self.source_triangulation.max_order+1))
-        for curve in curves:
-            curve_image = curve
+        for batch in [curves[:1], curves[1:]]:
+            images = batch
             for i in range(1, max(possible_orders)+1):
-                curve_image = self(curve_image)
-                if curve_image != curve:
+                images = self.apply_many(images)
+                if images != batch:
                     possible_orders.discard(i)
                     if not possible_orders: return 0  # No finite orders remain so we are infinite order.
         
@@ -201,7 +374,11 @@ class Encoding(object):
     def is_identity(self):
         ''' Return if this encoding is the identity map. '''
         
-        return self.is_mapping_class() and all(self(curve) == curve for curve in self.source_triangulation.key_curves())
+        if not self.is_mapping_class():
+            return False
+        
+        curves = self.source_triangulation.key_curves()
+        return self.apply_many(curves) == curves
     
     def is_periodic(self):
         ''' Return if this encoding has finite order.
@@ -226,35 +403,73 @@ class Encoding(object):
     
     def applied_geometric(self, lamination):
         ''' Return the action and condition matrices describing the PL map
-        applied to the geometric coordinates of the given lamination. '''
+        applied to the geometric coordinates of the given lamination.
+        
+        The action matrix is updated one row at a time and the condition rows
+        are collected as we go, so this takes O(len(self) * zeta) operations.
+        While its entries are provably small enough we build the action matrix
+        using int64 NumPy arrays, after that we fall back to Python integers. '''
         
         assert isinstance(lamination, flipper.kernel.Lamination)
         
-        As = flipper.kernel.id_matrix(self.zeta)
-        Cs = flipper.kernel.zero_matrix(self.zeta, 1)
+        geometric, algebraic = list(lamination.geometric), list(lamination.algebraic)
+        action = np.identity(self.zeta, dtype=np.int64)
+        conditions = [np.zeros(self.zeta, dtype=np.int64)]
+        bound = 1  # An upper bound on the absolute value of the entries of action while it is int64.
         for item in reversed(self.sequence):  # We can't just reverse self as reversed requires a list not an iterator.
-            # This now uses the improved sparse matrix representation.
-            As, C = item.applied_geometric(lamination, As)
-            Cs = Cs.join(C)
-            lamination = item(lamination)
+            program = item.compile()
+            if action.dtype == np.int64:
+                if flipper.kernel.moves.int64_steps(program, 0, bound, 3) < len(program):
+                    # Our bound is not good enough so compute a better one.
+                    bound = int(np.abs(action).max())
+                    if flipper.kernel.moves.int64_steps(program, 0, bound, 3) < len(program):
+                        action = action.astype(object)  # Switch to Python integers.
+                bound = bound * 3**sum(1 for instruction in program if instruction[0] == flipper.kernel.moves.FLIP)
+            
+            if any(instruction[0] == flipper.kernel.moves.APPLY for instruction in program):
+                # We have to fall back to the (much slower) Matrix interface of this move.
+                As, C = item.applied_geometric(item.source_triangulation.lamination(geometric, algebraic, remove_peripheral=False), flipper.kernel.Matrix(action.tolist()))
+                action = np.array(As.rows, dtype=object)
+                conditions.extend(np.array(row, dtype=object) for row in C)
+            else:
+                action = flipper.kernel.moves.execute_action(program, geometric, action, conditions)
+            geometric, algebraic = flipper.kernel.moves.execute(program, geometric, algebraic)
         
-        return As, Cs
+        return flipper.kernel.Matrix(action.tolist()), flipper.kernel.Matrix([row.tolist() for row in conditions])
     
     def pl_action(self):
         ''' Yield each of the action, condition matrix pairs describing the action of this Encoding
-        on ML. '''
-        
-        for sequence in product(*[range(len(item)) for item in self]):
-            As = flipper.kernel.id_matrix(self.zeta)
-            Cs = flipper.kernel.zero_matrix(self.zeta, 1)
-            for item, index in reversed(list(zip(self, sequence))):
-                # This now uses the improved sparse matrix representation.
-                As, C = item.pl_action(index, action=As)
-                Cs = Cs.join(C)
-        
-            yield (As, Cs)
+        on ML.
+        
+        The cells are explored depth first so cells with a common prefix share the work of
+        building it. A branch is pruned as soon as its conditions, together with v >= 0, cut
+        out a cone with empty interior and so only the cells that meet the interior of
+        ML are yielded. '''
+        
+        items = list(reversed(self.sequence))  # The order in which the items act.
+        orthant = flipper.kernel.id_matrix(self.zeta)  # ML lives in the non-negative orthant.
+        # Each entry also records a point in the interior of its cell.
+        stack = [(0, flipper.kernel.id_matrix(self.zeta), flipper.kernel.zero_matrix(self.zeta, 1), [1] * self.zeta)]
+        while stack:
+            depth, As, Cs, point = stack.pop()
+            if depth == len(items):
+                yield (As, Cs)
+            else:
+                children = []
+                for index in range(len(items[depth])):
+                    action, C = items[depth].pl_action(index, action=As)
+                    conditions = Cs.join(C)
+                    # We only need to look for a new interior point if the old one violates C.
+                    if all(flipper.kernel.matrix.dot(row, point) > 0 for row in C if any(row)):
+                        children.append((depth + 1, action, conditions, point))
+                    else:
+                        new_point = orthant.join(conditions).interior_point()
+                        if new_point is not None:
+                            children.append((depth + 1, action, conditions, new_point))
+                stack.extend(reversed(children))  # So that index 0 is explored first.
     
     @memoize
+    @persist
     def pml_fixedpoint(self):
         ''' Return a rescaling constant and projectively invariant lamination.
         
@@ -313,6 +528,7 @@ class Encoding(object):
             lmbda, _ = self.pml_fixedpoint()
             return lmbda
     
+    @persist
     def splitting_sequences(self, take_roots=False):
         ''' Return a list of splitting sequences associated to this mapping class.
         
@@ -361,11 +577,13 @@ class Encoding(object):
         else:  # len(homology_splittings) > 1:
             raise flipper.FatalError('Mapping class is homologous to multiple splitting sequences.')
     
+    @persist
     def canonical(self):
         ''' Return the canonical form of this mapping class. '''
         
         return self.splitting_sequence().mapping_class
     
+    @persist
     def nielsen_thurston_type(self):
         ''' Return the Nielsen--Thurston type of this encoding.
         
@@ -500,6 +718,7 @@ class Encoding(object):
         
         return M
     
+    @persist
     def bundle(self, veering=True, _safety=True):
         ''' Return the bundle associated to this mapping class.
         
@@ -1,12 +1,21 @@
 
 ''' A module for representing triangulations along with laminations and mapping classes on them.
 
-Provides one class: EquippedTriangulation. '''
+Provides one class: EquippedTriangulation.
 
-from itertools import product
+There is also a namedtuple: Classification. '''
+
+from collections import namedtuple
+try:
+    from concurrent.futures import ProcessPoolExecutor, FIRST_COMPLETED, wait
+    from concurrent.futures.process import BrokenProcessPool
+except ImportError:  # Python 2, so classify_many can only use a single core.
+    ProcessPoolExecutor = None
+from itertools import islice, product
 from random import choice
 import multiprocessing
 import re
+import signal
 
 import flipper
 
@@ -27,30 +36,45 @@ def generate_ordering(letters):
 
 ##########################################################################
 # A helper function  that can be pickled for multiprocessing.
-def _worker_thread_word(Q, A):
+def _worker_thread_search(Q, A, surface, length, options, mapping_classes):
+    # We need to rebuild the ordering as this couldn't be passed through the pickle.
+    options = dict(options)
+    options['order'] = generate_ordering(options['letters'])
     while True:
         data = Q.get()
         if data is None: break
         
-        surface, length, prefix, options = data
-        # We need to rebuild the ordering as this couldn't be passed through the pickle.
-        options['order'] = generate_ordering(options['letters'])
-        for output in surface._all_words_joined(length, prefix, **options):
-            A.put(output)
-    A.put(None)
+        task, prefixes, budget = data
+        words, remaining = surface._search(length, prefixes, budget, **options)
+        outputs = [surface.mapping_class('.'.join(word)) if mapping_classes else '.'.join(word) for word in words]
+        if options['apply'] is not None:
+            outputs = [options['apply'](output) for output in outputs]
+        A.put((task, outputs, remaining))
 
-def _worker_thread_mapping_class(Q, A):
-    while True:
-        data = Q.get()
-        if data is None: break
-        
-        surface, length, prefix, options = data
-        # We need to rebuild the ordering as this couldn't be passed through the pickle.
-        options['order'] = generate_ordering(options['letters'])
-        for output in surface._all_mapping_classes(length, prefix, **options):
-            A.put(output)
-    A.put(None)
+# The result of classifying the mapping class given by a word, see EquippedTriangulation.classify.
+Classification = namedtuple('Classification', ['word', 'nielsen_thurston_type', 'dilatation', 'order', 'error'])
 
+# Each worker process of classify_many receives the EquippedTriangulation once and stores it here.
+_CLASSIFY_SURFACE = None
+
+def _initialise_classifier(surface):
+    global _CLASSIFY_SURFACE  # pylint: disable=global-statement
+    _CLASSIFY_SURFACE = surface
+
+def _classify_words(words, timeout, surface=None):
+    # The surface is only sent with the words when the processes could not be initialised with it.
+    surface = _CLASSIFY_SURFACE if surface is None else surface
+    return [surface.classify(word, timeout) for word in words]
+
+def _classifier_pool(surface, cores):
+    # Return a pool of cores processes for classify_many and the surface to send along with each chunk of words.
+    try:
+        return ProcessPoolExecutor(cores, initializer=_initialise_classifier, initargs=(surface,)), None
+    except TypeError:  # Before Python 3.7 processes cannot be initialised.
+        return ProcessPoolExecutor(cores), surface
+
+def _timed_out(signum, frame):  # pylint: disable=unused-argument
+    raise flipper.AbortError('Timed out.')
 
 class EquippedTriangulation(object):
     ''' This represents a triangulation along with a collection of named laminations and mapping classes on it.
@@ -253,35 +277,75 @@ class EquippedTriangulation(object):
         Users should not call directly but should use self.all_words(...) instead.
         Assumes that various options have been set. '''
         
+        # We do a depth first search using a stack of the prefixes still to visit.
+        to_visit = [prefix]
+        while to_visit:
+            prefix = to_visit.pop()
+            if self._good_word(length, prefix, **options):
+                yield prefix
+            to_visit.extend(reversed(self._good_children(length, prefix, **options)))
+    
+    def _good_word(self, length, prefix, **options):
+        ''' Return whether prefix is one of the words that self._all_words_unjoined(length, ...) yields. '''
+        
         order = options['order']
         letters = options['letters']
+        lp = len(prefix)
+        
+        if options['exact'] and len(prefix) != length:
+            return False
+        
+        prefix_inv = inverse(prefix)
+        
+        if options['conjugacy'] and prefix[-1:] == inverse(prefix[:1]): return False
+        if options['conjugacy'] and not all(order(prefix[i:] + prefix[:i], prefix) for i in range(lp)): return False
+        if options['bundle'] and all(x in letters for x in prefix_inv):
+            if not all(order(prefix_inv[i:] + prefix_inv[:i], prefix) for i in range(lp)): return False
+        if options['filter'] is not None and not options['filter'](prefix): return False
+        
+        return True
+    
+    def _good_children(self, length, prefix, **options):
+        ''' Return the list of extensions of prefix by a single letter that self._all_words_unjoined(length, ...) searches. '''
+        
+        order = options['order']
         skip = options['skip']
         lp = len(prefix)
         lp2 = lp + 1
         
-        if not options['exact'] or len(prefix) == length:
-            prefix_inv = inverse(prefix)
+        if len(prefix) >= length:
+            return []
+        if options['prefilter'] is not None and not options['prefilter'](prefix):
+            return []
+        
+        children = []
+        for letter in options['letters']:
+            prefix2 = prefix + (letter,)
             
             good = True
-            if good and options['conjugacy'] and prefix[-1:] == inverse(prefix[:1]): good = False
-            if good and options['conjugacy'] and not all(order(prefix[i:] + prefix[:i], prefix) for i in range(lp)): good = False
-            if good and options['bundle'] and all(x in letters for x in prefix_inv):
-                if not all(order(prefix_inv[i:] + prefix_inv[:i], prefix) for i in range(lp)): good = False
-            if good and options['filter'] is not None and not options['filter'](prefix): good = False
+            if good and options['group'] and prefix and any(prefix2[i:] in skip for i in range(lp2)): good = False
+            if good and options['conjugacy'] and not all(order(prefix2[i:2*i], prefix2[:min(i, lp2-i)]) for i in range(lp2 // 2, lp)): good = False
             if good:
-                yield prefix
+                children.append(prefix2)
         
-        if len(prefix) < length:
-            for letter in letters:
-                prefix2 = prefix + (letter,)
-                
-                good = True
-                if good and options['group'] and prefix and any(prefix2[i:] in skip for i in range(lp2)): good = False
-                if good and options['conjugacy'] and not all(order(prefix2[i:2*i], prefix2[:min(i, lp2-i)]) for i in range(lp2 // 2, lp)): good = False
-                if good and options['prefilter'] is not None and not options['prefilter'](prefix): good = False
-                if good:
-                    for word in self._all_words_unjoined(length, prefix2, **options):
-                        yield word
+        return children
+    
+    def _search(self, length, prefixes, max_prefixes, **options):
+        ''' Return the words below the given prefixes found by searching at most max_prefixes prefixes and the list of prefixes left to search.
+        
+        The words below the prefixes left to search all come after the words found in the order
+        that self._all_words_unjoined uses. Users should not call directly. '''
+        
+        words = []
+        to_visit = list(reversed(prefixes))
+        for _ in range(max_prefixes):
+            if not to_visit: break
+            prefix = to_visit.pop()
+            if self._good_word(length, prefix, **options):
+                words.append(prefix)
+            to_visit.extend(reversed(self._good_children(length, prefix, **options)))
+        
+        return words, to_visit[::-1]
     
     def _all_words_joined(self, length, prefix, **options):
         for word in self._all_words_unjoined(length, prefix, **options):
@@ -314,7 +378,8 @@ class EquippedTriangulation(object):
             - filter=None -- filter the words by this function.
             - apply=None -- apply the given function to the words.
             - cores=None -- how many cores to use.
-            - prefix_depth=4 -- depth to search for prefixes for other cores.
+            - budget=1000 -- how many prefixes a core searches before handing back the rest, if using multiple cores.
+            - ordered=False -- yield the words in the same order as when using a single core, if using multiple cores.
         
         Notes:
         
@@ -341,7 +406,8 @@ class EquippedTriangulation(object):
             'filter': None,
             'apply': None,
             'cores': None,
-            'prefix_length': 4
+            'budget': 1000,
+            'ordered': False
             }
         
         # Install any missing options with defaults.
@@ -375,38 +441,8 @@ class EquippedTriangulation(object):
             for word in self._all_words_joined(length, prefix, **options):
                 yield word
         else:
-            temp_options = dict(options)
-            temp_options['conjugacy'] = False
-            temp_options['bundle'] = False
-            temp_options['exact'] = True
-            temp_options['filter'] = None
-            if options['prefix_length'] <= length:
-                prefixes = [(self, length, leaf, node_options) for leaf in self._all_words_unjoined(options['prefix_length'], prefix, **temp_options)]
-            else:
-                prefixes = []
-            
-            Q = multiprocessing.Queue()
-            A = multiprocessing.Queue()
-            P = [multiprocessing.Process(target=_worker_thread_word, args=(Q, A)) for i in range(options['cores'])]
-            for p in P: p.daemon = True
-            for p in P: p.start()
-            
-            Q.put((self, min(options['prefix_length']-1, length), prefix, node_options))
-            for data in prefixes:
-                Q.put(data)
-            
-            for i in range(options['cores']):
-                Q.put(None)
-            
-            num_completed_cores = 0
-            while num_completed_cores < options['cores']:
-                result = A.get()
-                if result is None:
-                    num_completed_cores += 1
-                else:
-                    yield result
-            
-            for p in P: p.terminate()
+            for output in self._parallel_search(length, prefix, node_options, False):
+                yield output
     
     def all_mapping_classes(self, length, prefix=None, **options):
         ''' Yield all mapping classes of at most the specified length.
@@ -429,7 +465,8 @@ class EquippedTriangulation(object):
             - filter=None -- filter the words by this function.
             - apply=None -- apply the given function to the words.
             - cores=None -- how many cores to use.
-            - prefix_depth=3 -- depth to search for prefixes for other cores.
+            - budget=100 -- how many prefixes a core searches before handing back the rest, if using multiple cores.
+            - ordered=False -- yield the mapping classes in the same order as when using a single core, if using multiple cores.
         
         Notes:
         
@@ -456,7 +493,8 @@ class EquippedTriangulation(object):
             'filter': None,
             'apply': None,
             'cores': None,
-            'prefix_length': 3
+            'budget': 100,
+            'ordered': False
             }
         
         # Install any missing options with defaults.
@@ -490,37 +528,172 @@ class EquippedTriangulation(object):
             for word in self._all_mapping_classes(length, prefix, **options):
                 yield word
         else:
-            temp_options = dict(options)
-            temp_options['conjugacy'] = False
-            temp_options['bundle'] = False
-            temp_options['exact'] = True
-            temp_options['filter'] = None
-            if options['prefix_length'] <= length:
-                prefixes = [(self, length, leaf, node_options) for leaf in self._all_words_unjoined(options['prefix_length'], prefix, **temp_options)]
-            else:
-                prefixes = []
-            
-            Q = multiprocessing.Queue()
-            A = multiprocessing.Queue()
-            P = [multiprocessing.Process(target=_worker_thread_mapping_class, args=(Q, A)) for i in range(options['cores'])]
-            for p in P: p.daemon = True
-            for p in P: p.start()
-            
-            Q.put((self, min(options['prefix_length']-1, length), prefix, node_options))
-            for data in prefixes:
-                Q.put(data)
-            
-            for i in range(options['cores']):
-                Q.put(None)
-            
-            num_completed_cores = 0
-            while num_completed_cores < options['cores']:
-                result = A.get()
-                if result is None:
-                    num_completed_cores += 1
+            for output in self._parallel_search(length, prefix, node_options, True):
+                yield output
+    
+    def classify(self, word, timeout=None):
+        ''' Return the Classification of the mapping class given by word.
+        
+        This records its Nielsen--Thurston type, dilatation and order. If this fails, or
+        takes more than timeout seconds, then these are None and the error is recorded
+        instead. Timeouts use SIGALRM and so only work in the main thread. On platforms
+        without SIGALRM, such as Windows, timeout is ignored. '''
+        
+        timeout = timeout if hasattr(signal, 'SIGALRM') else None
+        if timeout is not None:
+            handler = signal.signal(signal.SIGALRM, _timed_out)
+        try:
+            if timeout is not None:
+                signal.setitimer(signal.ITIMER_REAL, timeout)  # Inside the try since a short timeout can expire straight away.
+            mapping_class = self.mapping_class(word)
+            nt_type = mapping_class.nielsen_thurston_type()
+            return Classification(word, nt_type, mapping_class.dilatation(), mapping_class.order(), None)
+        except Exception as error:  # pylint: disable=broad-except
+            return Classification(word, None, None, None, '%s: %s' % (type(error).__name__, error))
+        finally:
+            if timeout is not None:
+                signal.setitimer(signal.ITIMER_REAL, 0)
+                signal.signal(signal.SIGALRM, handler)
+    
+    def classify_many(self, words, cores=None, timeout=None, retries=1, ordered=True, chunksize=16):
+        ''' Yield the Classification of the mapping class given by each of the words.
+        
+        If cores is given then the words are classified by a pool of this many processes.
+        Each of these receives this EquippedTriangulation once and after that only words
+        are sent to them, chunksize at a time. If ordered is True then the Classifications
+        are yielded in the same order as the words, otherwise they are yielded as soon as
+        they are ready.
+        
+        Words that take longer than timeout seconds are given a Classification recording the
+        error, see EquippedTriangulation.classify. If a process dies, for example by running
+        out of memory, then each word it was working on is retried on its own up to retries
+        more times before it too is given such a Classification. Using more than one core
+        requires concurrent.futures and so on Python 2 the words are always classified by
+        this process. '''
+        
+        assert cores is None or (isinstance(cores, flipper.IntegerType) and cores > 0)
+        assert isinstance(retries, flipper.IntegerType) and retries >= 0
+        
+        if cores is None or ProcessPoolExecutor is None:
+            # Just use the single core algorithm:
+            for word in words:
+                yield self.classify(word, timeout)
+            return
+        
+        # A chunk is a list of (index, word) pairs together with the number of times it has been tried.
+        words = enumerate(words)
+        chunks = iter(lambda: (list(islice(words, chunksize)), 0), ([], 0))
+        retry = []  # Chunks that need to be tried again.
+        pending = dict()  # Mapping futures to the chunk that they are classifying.
+        results = dict()  # Mapping indices to Classifications that we have not yet yielded.
+        next_index = 0
+        executor, surface = _classifier_pool(self, cores)
+        try:
+            while True:
+                # Keep every process busy, with a little to spare, without reading all of the words at once.
+                while len(pending) < 2 * cores:
+                    chunk = retry.pop() if retry else next(chunks, None)
+                    if chunk is None: break
+                    pending[executor.submit(_classify_words, [word for _, word in chunk[0]], timeout, surface)] = chunk
+                if not pending: break
+                
+                finished, _ = wait(pending, return_when=FIRST_COMPLETED)
+                failed = []  # Chunks whose process died.
+                for future in finished:
+                    chunk, attempts = pending.pop(future)
+                    try:
+                        classifications = future.result()
+                    except BrokenProcessPool:
+                        failed.append((chunk, attempts))
+                        continue
+                    for (index, _), classification in zip(chunk, classifications):
+                        results[index] = classification
+                
+                if failed:
+                    # Every future still pending that has not already finished has also failed,
+                    # so start a new pool.
+                    for future, (chunk, attempts) in pending.items():
+                        if future.done() and future.exception() is None:
+                            for (index, _), classification in zip(chunk, future.result()):
+                                results[index] = classification
+                        else:
+                            failed.append((chunk, attempts))
+                    pending = dict()
+                    executor.shutdown(wait=False)
+                    executor, surface = _classifier_pool(self, cores)
+                    
+                    # We don't know which word killed the process so try them all separately. This counts as an
+                    # attempt for every chunk that failed, so that word cannot keep breaking the pool.
+                    for chunk, attempts in failed:
+                        if attempts < retries:
+                            retry.extend(([item], attempts + 1) for item in chunk)
+                        else:
+                            for index, word in chunk:
+                                results[index] = Classification(word, None, None, None, 'BrokenProcessPool: A process died.')
+                
+                if ordered:
+                    while next_index in results:
+                        yield results.pop(next_index)
+                        next_index += 1
                 else:
-                    yield result
-            
+                    for index in list(results):
+                        yield results.pop(index)
+        finally:
+            for future in pending:
+                future.cancel()
+            executor.shutdown(wait=False)
+    
+    def _parallel_search(self, length, prefix, options, mapping_classes):
+        ''' Yield the words (or mapping classes) below prefix using options['cores'] processes.
+        
+        Each process is sent this EquippedTriangulation once. It is then repeatedly sent a list
+        of prefixes, searches below them until it has visited options['budget'] prefixes and
+        sends back a batch of results along with the prefixes it did not get to. When there
+        are idle processes these are split up between them, so large subtrees are divided
+        on demand. Users should not call directly but should use self.all_words(...) or
+        self.all_mapping_classes(...) instead. '''
+        
+        cores, budget = options['cores'], options['budget']
+        Q = multiprocessing.Queue()
+        A = multiprocessing.Queue()
+        P = [multiprocessing.Process(target=_worker_thread_search, args=(Q, A, self, length, options, mapping_classes)) for i in range(cores)]
+        for p in P: p.daemon = True
+        for p in P: p.start()
+        
+        try:
+            Q.put((0, [prefix], budget))
+            num_tasks = 1
+            num_outstanding = 1
+            # If we are keeping things in order then we need to remember the results of each task
+            # and the tasks that it split into. The results come in the order given by doing a depth
+            # first search of this tree of tasks, which we do using a stack of the tasks to visit.
+            results = dict()
+            to_visit = [0]
+            while num_outstanding:
+                task, outputs, remaining = A.get()
+                num_outstanding -= 1
+                
+                # Split the remaining prefixes into as many contiguous pieces as there are idle processes.
+                num_pieces = min(len(remaining), max(cores - num_outstanding, 1))
+                subtasks = []
+                for i in range(num_pieces):
+                    piece = remaining[i * len(remaining) // num_pieces:(i+1) * len(remaining) // num_pieces]
+                    Q.put((num_tasks, piece, budget))
+                    subtasks.append(num_tasks)
+                    num_tasks += 1
+                    num_outstanding += 1
+                
+                if options['ordered']:
+                    results[task] = (outputs, subtasks)
+                    while to_visit and to_visit[-1] in results:
+                        outputs, subtasks = results.pop(to_visit.pop())
+                        for output in outputs:
+                            yield output
+                        to_visit.extend(reversed(subtasks))
+                else:
+                    for output in outputs:
+                        yield output
+        finally:
             for p in P: p.terminate()
     
     def decompose_word(self, word):
@@ -3,7 +3,6 @@
 
 Provides one class: Lamination. '''
 
-import heapq
 try:
     from Queue import Queue
 except ImportError:
@@ -13,7 +12,8 @@ import flipper
 from flipper.kernel.decorators import memoize  # Special import needed for decorating.
 
 INFTY = float('inf')
-HASH_DENOMINATOR = 30
+HASH_DENOMINATOR = 30  # The number of decimal places that projective_hash uses for laminations with integer weights.
+HASH_DIGITS = 10  # The number of decimal places that projective_hash uses for laminations over the simplest fields.
 
 class Lamination(object):
     ''' This represents a lamination on an triangulation.
@@ -133,8 +133,43 @@ class Lamination(object):
         
         assert isinstance(other, Lamination)
         
-        # This could be faster, we could build a smaller collection of isometries to begin with.
-        return [isometry for isometry in self.triangulation.isometries_to(other.triangulation) if other.projectively_equal(isometry.encode()(self))]
+        if self.zeta != other.zeta:
+            return []
+        
+        # Compare the laminations using the same precision.
+        precision = self.hash_precision()
+        if self.fingerprint(precision) != other.fingerprint(precision):
+            return []
+        
+        source_signatures, target_signatures = self.corner_signatures(precision), other.corner_signatures(precision)
+        targets = dict()
+        for label, signature in target_signatures.items():
+            targets.setdefault(signature, []).append(label)
+        
+        # Isometries are determined by where a single corner is sent and it must be sent
+        # to a corner with the same signature. So we start from the corner that has the
+        # fewest possible images.
+        source_label = min(source_signatures, key=lambda label: (len(targets[source_signatures[label]]), label))
+        L, M = self.projective_weights(precision), other.projective_weights(precision)
+        w, v = self.weight(), other.weight()
+        isometries = []
+        for target_label in targets[source_signatures[source_label]]:
+            try:
+                isometry = self.triangulation.find_isometry(other.triangulation, {source_label: target_label})
+            except flipper.AssumptionError:
+                continue
+            
+            # Check the approximate weights before doing any exact arithmetic. This is then
+            # the same as other.projectively_equal(isometry.encode()(self)) but stops as soon
+            # as an edge does not match.
+            if all(M[isometry.index_map[i]] == L[i] for i in self.triangulation.indices) and \
+                    all(other(isometry.label_map[i]) * w == self(i) * v and other[isometry.label_map[i]] * w == self[i] * v for i in self.triangulation.indices):
+                isometries.append(isometry)
+        
+        # Return these in the same order as Triangulation.isometries_to does.
+        source_corner = min(self.triangulation.corner_classes, key=len)[0]
+        order = dict((corner.label, position) for position, corner in enumerate(corner for corner_class in other.triangulation.corner_classes for corner in corner_class))
+        return sorted(isometries, key=lambda isometry: order[isometry.label_map[source_corner.label]])
     
     def projectively_equal(self, other):
         ''' Return if this lamination is projectively equal to other.
@@ -147,18 +182,98 @@ class Lamination(object):
         # We can't do division so we have to cross multiply.
         return self * other.weight() == other * self.weight()
     
-    def projective_hash(self, precision=HASH_DENOMINATOR):
-        ''' Return a hashable object that is invariant under isometries and rescaling. '''
+    @memoize
+    def approximate_weights(self, accuracy):
+        ''' Return a list of pairs (lower, upper) such that each weight lies in [lower / 10**accuracy, upper / 10**accuracy]. '''
+        
+        scale = 10**accuracy
+        approximations = []
+        for x in self:
+            if isinstance(x, flipper.kernel.RealAlgebraic):
+                interval = x.interval(accuracy).simplify(accuracy)
+                approximations.append((interval.lower, interval.upper))
+            else:
+                approximations.append((x * scale, x * scale))
+        
+        return approximations
+    
+    def hash_precision(self):
+        ''' Return the number of decimal places that projective_hash uses by default.
+        
+        Projectively distinct laminations can agree to more places when their weights
+        lie in a field of larger degree and height, so this grows with them. '''
+        
+        fields = set(entry.field for entry in self if isinstance(entry, flipper.kernel.RealAlgebraic))
+        if not fields:
+            return HASH_DENOMINATOR
+        
+        return HASH_DIGITS + int(max(field.length for field in fields))
+    
+    @memoize
+    def projective_weights(self, precision=None):
+        ''' Return the list of the first precision decimal places of the normalised weights.
+        
+        If precision is not given then hash_precision() places are used. These are computed
+        using approximate_weights() and we only fall back to exact arithmetic if they are too
+        close to call. '''
+        
+        if precision is None: precision = self.hash_precision()
+        
+        scale = 10**precision
+        accuracy = precision + HASH_DIGITS
+        for _ in range(4):
+            approximations = self.approximate_weights(accuracy)
+            lower_weight, upper_weight = sum(lower for lower, _ in approximations), sum(upper for _, upper in approximations)
+            if lower_weight > 0:
+                L = [lower * scale // upper_weight for lower, _ in approximations]
+                if L == [upper * scale // lower_weight for _, upper in approximations]:
+                    return L
+            accuracy *= 2
         
-        # Normalise so that it is invariant under rescaling and sort to make it invariant under isometries.
         w = self.weight()
-        L = [x * 10**precision // w for x in self]
+        return [x * scale // w for x in self]
+    
+    @memoize
+    def projective_hash(self, precision=None):
+        ''' Return a hashable object that is invariant under isometries and rescaling.
+        
+        This is built from projective_weights(precision). '''
+        
+        # Normalise so that it is invariant under rescaling and sort to make it invariant under isometries.
+        L = self.projective_weights(precision)
         
         # We'll try to preserve as much of the structure as possible to try to reduce hash collisions.
         # In this version we'll store the sorted, cyclically ordered, triangles.
         triples = [tuple([L[edge.index] for edge in triangle]) for triangle in self.triangulation]
         return tuple(sorted([min(triple[i:] + triple[:i] for i in range(len(triple))) for triple in triples]))
     
+    @memoize
+    def corner_signatures(self, precision=None):
+        ''' Return a dictionary mapping the label of each corner to its signature.
+        
+        This records projective_weights(precision) of the edges of the corner together with
+        those of all of the corners around the same vertex, starting from the smallest. Any
+        isometry taking this lamination projectively to another must preserve signatures. '''
+        
+        L = self.projective_weights(precision)
+        signatures = dict()
+        for corner_class in self.triangulation.corner_classes:
+            triples = [tuple(L[index] for index in corner.indices) for corner in corner_class]
+            vertex_signature = (corner_class[0].vertex.filled, min(tuple(triples[i:] + triples[:i]) for i in range(len(triples))))
+            for corner, triple in zip(corner_class, triples):
+                signatures[corner.label] = (vertex_signature, triple)
+        
+        return signatures
+    
+    @memoize
+    def fingerprint(self, precision=None):
+        ''' Return a hashable object that is invariant under isometries and rescaling.
+        
+        This is finer than projective_hash(precision) as it is built from the signatures of
+        all of the corners, see corner_signatures(). '''
+        
+        return tuple(sorted(self.corner_signatures(precision).values()))
+    
     def weight(self):
         ''' Return the sum of the geometric intersection numbers of this lamination. '''
         
@@ -549,13 +664,13 @@ class Lamination(object):
         Assumes (and checks) that this lamination is filling.
         
         Each entry of self.geometric must be an Integer or a RealAlgebraic (over
-        the same RealNumberField). '''
+        the same RealNumberField).
+        
+        See SplittingSearch for a version of this which can be paused and resumed. '''
         
         # In this method we use Lamination.projective_hash to store the laminations
-        # we encounter efficiently and so avoid a quadratic algorithm. This currently
-        # only ever uses the default precision HASH_DENOMINATOR. At some point this
-        # should change dynamically depending on the algebraic numbers involved in
-        # this lamination.
+        # we encounter efficiently and so avoid a quadratic algorithm. Its precision
+        # depends on the field that the weights of this lamination lie in.
         
         assert all(isinstance(entry, (flipper.IntegerType, flipper.kernel.RealAlgebraic)) for entry in self)
         assert len(set(entry.field for entry in self if isinstance(entry, flipper.kernel.RealAlgebraic))) <= 1
@@ -569,123 +684,7 @@ class Lamination(object):
         if any(entry == 0 for entry in self):
             raise flipper.AssumptionError('Lamination is not filling.')
         
-        # We should call lamination.collapse_trivial_weight(flip_index) on each
-        # weight 0 edge and rely on it to either collapse the edge or raise the
-        # approprate error.
-        
-        lamination = self
-        encodings = []
-        # Puncture all the triangles where the lamination is a tripod.
-        E = lamination.puncture_tripods()
-        lamination = E(lamination)
-        encodings.append(E)
-        
-        # This is a dict taking the hash of each lamination to the index where we saw it.
-        target = lamination.projective_hash()
-        seen = dict()
-        # We then want a second dictionary taking indices where laminations occur back to
-        # the lamination. This can use a lot of memory however as Tao's K(S) can grow very
-        # large when the surface has high genus. To get around this we note that we will only
-        # ever lookup laminations that occur in the last maxlen steps, which is at least the
-        # periodic length of this sequence. So we create a bunch of dictionaries that we
-        # cycle through. This way their union will always contain the last maxlen indices
-        # and will only contain at most maxlen * NUM_LAM_BLOCKS / (NUM_LAM_BLOCKS - 1) laminations.
-        NUM_LAM_BLOCKS = 5
-        laminations = [dict() for i in range(NUM_LAM_BLOCKS)]
-        current_block = 0  # This records which dictionary we are currently filling.
-        
-        seen[target] = [1]
-        laminations[current_block][1] = lamination
-        
-        # We'll store the edge weights in a maximal heap using heapq. This allows us to quickly find the maximal weight edges.
-        flip_first = lambda x: (-x[0], x[1])  # A small function allowing us to use Pythons defaul min heap as a max heap.
-        weights_heap = [flip_first((weight, index)) for index, weight in enumerate(lamination)]
-        heapq.heapify(weights_heap)
-        # Get the index of the largest weight edge.
-        flip_weight, flip_index = flip_first(heapq.heappop(weights_heap))
-        while True:
-            max_weight = flip_weight
-            # Flip all edges weight max_weight. As the heap outputs these in sorted order,
-            # we do this by popping an element and flipping it until we reach one of
-            # weight < max_weight.
-            while flip_weight == max_weight:
-                # Do the flip.
-                E = lamination.triangulation.encode_flip(flip_index)
-                lamination = E(lamination)
-                # Record information about the flip.
-                encodings.append(E)
-                
-                # Check if we have created any edges of weight 0. Of course it is enough to just check flip_index.
-                if lamination(flip_index) == 0:
-                    try:
-                        # If this fails it's because the lamination isn't filling.
-                        lamination, E = lamination.collapse_trivial_weight(flip_index)
-                        encodings.append(E)
-                        # Need to rebuild the heap as indices no longer correspond.
-                        weights_heap = [flip_first((weight, index)) for index, weight in enumerate(lamination)]
-                        heapq.heapify(weights_heap)
-                    except flipper.AssumptionError:
-                        raise flipper.AssumptionError('Lamination is not filling.')
-                else:
-                    # Add the new edge weight back into the heap.
-                    heapq.heappush(weights_heap, flip_first((lamination(flip_index), flip_index)))
-                
-                # Get the next largest edge.
-                flip_weight, flip_index = flip_first(heapq.heappop(weights_heap))
-            
-            # print(len(encodings))
-            
-            # Record this lamination in the dictionary of seen laminations.
-            # To cut down on memory usage we will only retain the last maxlen laminations
-            # at any given point.
-            if maxlen is not None and len(laminations[current_block]) > maxlen // (NUM_LAM_BLOCKS - 1):
-                # Move to the (cyclically) next block and reset it with just this lamination.
-                current_block = (current_block + 1) % NUM_LAM_BLOCKS
-                laminations[current_block] = {len(encodings): lamination}
-            else:
-                laminations[current_block][len(encodings)] = lamination
-            
-            # Check if lamination now (projectively) matches a lamination we've already seen.
-            target = lamination.projective_hash()
-            if target in seen:
-                # print(seen[target])
-                for index in seen[target]:
-                    for i in range(NUM_LAM_BLOCKS):
-                        if index in laminations[i]:
-                            old_lamination = laminations[i][index]
-                            break
-                    else:
-                        # This index has moved out of the lamination dictionaries and so is
-                        # too old to be the start point of the periodic cycle.
-                        continue
-                    
-                    # In the next block we have a lot of tests to do. We'll do these in
-                    # order of difficulty of computation. For example, computing
-                    # projective_isometries is slow; so we'll leave that to last to give
-                    # us the best chance that a faster test failing will allow us to
-                    # skip it.
-                    if dilatation is None or old_lamination.weight() >= dilatation * lamination.weight():
-                        isometries = lamination.all_projective_isometries(old_lamination)
-                        if isometries:
-                            assert dilatation is None or old_lamination.weight() == dilatation * lamination.weight()
-                            # print('!!', index)
-                            
-                            encoding = flipper.kernel.Encoding([move for item in reversed(encodings) for move in item])
-                            return flipper.kernel.SplittingSequences(encoding, isometries, index, dilatation, old_lamination)
-                    else:
-                        # dilatation is not None and:
-                        #   old_lamination.weight() < dilatation * lamination.weight():
-                        # Note that the weight of laminations is strictly decreasing and the
-                        # indices of seen[target] are increasing. Thus if we are in this case
-                        # then the same inequality holds for every later index in seen[target].
-                        # Hence we may break out.
-                        break
-                seen[target].append(len(encodings))
-            else:
-                # Start a new class containing this lamination.
-                seen[target] = [len(encodings)]
-        
-        raise RuntimeError('Unreachable code.')
+        return flipper.kernel.SplittingSearch(self, dilatation, maxlen).run()
     
     def encode_twist(self, k=1):
         ''' Return an Encoding of a left Dehn twist about this lamination raised to the power k.
@@ -728,11 +727,14 @@ class Lamination(object):
         # #---------->#
         # And e.index = e1 and b.index = d.index = e2.
         
-        # twist_k = flipper.kernel.Spiral(triangulation, triangulation, e1, k).encode()
-        # return conjugation.inverse() * twist_k * conjugation
+        # A single twist is cheapest as a flip and an isometry, which can be compiled,
+        # but for larger powers a Spiral avoids repeating these k times.
+        if abs(k) == 1:
+            twist = triangulation.encode([{i: i for i in triangulation.indices if i not in [e1, e2]}, e1])
+            return conjugation.inverse() * twist**k * conjugation
         
-        twist = triangulation.encode([{i: i for i in triangulation.indices if i not in [e1, e2]}, e1])
-        return conjugation.inverse() * twist**k * conjugation
+        twist_k = flipper.kernel.Spiral(triangulation, triangulation, e1, k).encode()
+        return conjugation.inverse() * twist_k * conjugation
     
     def encode_halftwist(self, k=1):
         ''' Return an Encoding of a left half twist about this lamination raised to the power k.
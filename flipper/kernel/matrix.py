@@ -5,6 +5,13 @@ Provides one class: Matrix.
 
 There are also helper functions: id_matrix and zero_matrix. '''
 
+from functools import reduce
+try:
+    from math import gcd
+    from fractions import Fraction
+except ImportError:  # Python 2.
+    from fractions import Fraction, gcd
+
 import numpy as np
 import realalg
 
@@ -150,6 +157,53 @@ class Matrix(object):
         
         return all(dot(row, v) >= 0 for row in self)
     
+    def interior_point(self):
+        ''' Return a vector v such that dot(row, v) > 0 for every non-zero row of self.
+        
+        Such a vector lies in the interior of the cone {v : self * v >= 0}. Returns None
+        if this cone has empty interior. As there is then also a solution to
+        dot(row, v) >= 1, we find one using the first phase of the simplex algorithm.
+        This is done exactly and so this matrix must have integer entries. '''
+        
+        # Rows that are positive multiples of each other impose the same condition. Note that
+        # we must divide by a positive number so as not to change the direction of a row.
+        rows = sorted(set(tuple(x // abs(reduce(gcd, row)) for x in row) for row in self if any(row)))
+        m, n = len(rows), self.width
+        if m == 0: return [0] * n
+        
+        # We write v = p - q and find p, q, s >= 0 with self * (p - q) - s = 1 by
+        # minimising the sum of artificial variables a >= 0 added to each equation.
+        # To avoid fractions we use the integer preserving version of the simplex
+        # algorithm, in which the true tableau is tableau / denominator.
+        num_columns = 2 * n + 2 * m
+        tableau = [list(row) + [-x for x in row] + [-1 if i == j else 0 for j in range(m)] + [1 if i == j else 0 for j in range(m)] + [1] for i, row in enumerate(rows)]
+        basis = [2 * n + m + i for i in range(m)]
+        objective = [-sum(tableau[i][j] for i in range(m)) if j < 2 * n + m else 0 for j in range(num_columns)] + [-m]
+        denominator = 1
+        
+        while True:
+            # Bland's rule ensures that this terminates.
+            entering = next((j for j in range(num_columns) if objective[j] < 0), None)
+            if entering is None:
+                break
+            
+            leaving = min((Fraction(tableau[i][-1], tableau[i][entering]), basis[i], i) for i in range(m) if tableau[i][entering] > 0)[2]
+            pivot_row, pivot = tableau[leaving], tableau[leaving][entering]
+            for row in tableau + [objective]:
+                if row is not pivot_row:
+                    scale = row[entering]
+                    row[:] = [(pivot * x - scale * y) // denominator for x, y in zip(row, pivot_row)]
+            denominator = pivot
+            basis[leaving] = entering
+        
+        if objective[-1] != 0:  # Some artificial variable could not be removed.
+            return None
+        
+        values = [0] * num_columns
+        for i, j in enumerate(basis):
+            values[j] = Fraction(tableau[i][-1], denominator)
+        return [values[j] - values[n + j] for j in range(n)]
+    
     def directed_eigenvector(self, condition_matrix):
         ''' Return an `interesting` (eigenvalue, eigenvector) pair  which lives inside of the cone C, defined by condition_matrix.
         
@@ -1,13 +1,163 @@
 
 ''' A module for representing basic ways of changing triangulations.
 
-Provides three classes: Isometry, EdgeFlip and LinearTransformation.
+Provides four classes: Isometry, EdgeFlip, Spiral and LinearTransformation. '''
 
-Perhaps in the future we will add a Spiral move so that curves can be
-shortened in polynomial time. '''
+import numpy as np
 
 import flipper
 
+# The opcodes of the instructions produced by Move.compile().
+APPLY, FLIP, ISOMETRY = 0, 1, 2
+
+# Entries of int64 arrays must stay below this in absolute value so that
+# the intermediate sums computed by a FLIP cannot overflow.
+INT64_BOUND = 2**62
+# Below this many laminations the overhead of NumPy outweighs its benefits.
+INT64_MIN_BATCH = 32
+
+def int64_steps(program, start, bound, growth):
+    ''' Return how many instructions of program, from start onwards, can be run in int64.
+    
+    This assumes that all entries are currently at most bound in absolute value and that
+    each FLIP can increase this by at most a factor of growth. We stop at the first APPLY
+    since we have no control over what its move does to the entries. '''
+    
+    steps = 0
+    bound = max(bound, 1)
+    while start + steps < len(program) and program[start + steps][0] != APPLY:
+        if program[start + steps][0] == FLIP:
+            if bound * growth >= INT64_BOUND:
+                break
+            bound = bound * growth
+        steps += 1
+    
+    return steps
+
+def execute_int64(program, geometric, algebraic):
+    ''' Apply the FLIP and ISOMETRY instructions of program to int64 NumPy arrays of weights.
+    
+    The arrays must have one row per edge and one column per lamination. It is up to
+    the caller to use int64_steps() to ensure that no entry can overflow. '''
+    
+    # We use preallocated buffers and the out= arguments to avoid creating temporary arrays.
+    ac, bd = np.empty(geometric.shape[1], dtype=np.int64), np.empty(geometric.shape[1], dtype=np.int64)
+    for instruction in program:
+        if instruction[0] == FLIP:
+            _, a, b, c, d, e, sign_b, sign_c = instruction
+            np.add(geometric[a], geometric[c], out=ac)
+            np.add(geometric[b], geometric[d], out=bd)
+            np.maximum(ac, bd, out=ac)
+            np.subtract(ac, geometric[e], out=geometric[e])
+            if sign_b == sign_c:
+                np.add(algebraic[b], algebraic[c], out=algebraic[e])
+            else:
+                np.subtract(algebraic[b], algebraic[c], out=algebraic[e])
+            if sign_b < 0:
+                np.negative(algebraic[e], out=algebraic[e])
+        else:  # instruction[0] == ISOMETRY:
+            _, indices, signs = instruction
+            geometric = geometric[list(indices)]
+            algebraic = algebraic[list(indices)] * np.array(signs, dtype=np.int64)[:, None]
+    
+    return geometric, algebraic
+
+def execute(program, geometric, algebraic):
+    ''' Apply the given program to the given geometric and algebraic weights.
+    
+    The program must be a sequence of instructions, as produced by Move.compile(),
+    listed in the order in which they are to be applied. The given lists are
+    updated in place wherever possible and the resulting pair of lists is returned. '''
+    
+    for instruction in program:
+        opcode = instruction[0]
+        if opcode == FLIP:
+            _, a, b, c, d, e, sign_b, sign_c = instruction
+            ac, bd = geometric[a] + geometric[c], geometric[b] + geometric[d]
+            geometric[e] = (ac if ac >= bd else bd) - geometric[e]
+            algebraic[e] = sign_b * algebraic[b] + sign_c * algebraic[c]
+        elif opcode == ISOMETRY:
+            _, indices, signs = instruction
+            geometric[:] = [geometric[i] for i in indices]
+            algebraic[:] = [algebraic[i] * sign for i, sign in zip(indices, signs)]
+        else:  # opcode == APPLY:
+            move = instruction[1]
+            geometric = move.apply_geometric(geometric)
+            algebraic = move.apply_algebraic(algebraic)
+    
+    return geometric, algebraic
+
+def execute_action(program, geometric, action, conditions):
+    ''' Apply the FLIP and ISOMETRY instructions of program to an action matrix.
+    
+    The action matrix must be a NumPy array and each FLIP only updates the one row
+    that it changes. The branch of each FLIP is chosen using the given geometric
+    weights, which are left unchanged, and a row is appended to conditions for each
+    FLIP recording the linear inequality that the action matrix must satisfy to be
+    in that branch. If action has dtype=int64 then it is up to the caller to use
+    int64_steps() to ensure that no entry can overflow. '''
+    
+    geometric = list(geometric)
+    for instruction in program:
+        if instruction[0] == FLIP:
+            _, a, b, c, d, e, _, _ = instruction
+            ac, bd = geometric[a] + geometric[c], geometric[b] + geometric[d]
+            if ac >= bd:
+                conditions.append(action[a] + action[c] - action[b] - action[d])
+                action[e] = action[a] + action[c] - action[e]
+            else:
+                conditions.append(action[b] + action[d] - action[a] - action[c])
+                action[e] = action[b] + action[d] - action[e]
+            geometric[e] = (ac if ac >= bd else bd) - geometric[e]
+        else:  # instruction[0] == ISOMETRY:
+            _, indices, _ = instruction
+            action = action[list(indices)]
+            geometric = [geometric[i] for i in indices]
+    
+    return action
+
+def execute_many(program, geometric, algebraic):
+    ''' Apply the given program to many geometric and algebraic weights simultaneously.
+    
+    This is the same as execute() except that geometric and algebraic must be lists
+    containing one row per edge, where each row lists the weight of that edge in
+    each of the laminations. The resulting pair of lists is returned.
+    
+    When there are enough laminations and all of their weights are integers, as
+    much of the program as possible is run using int64 NumPy arrays. We switch
+    back to Python integers as soon as a weight might exceed INT64_BOUND. '''
+    
+    position = 0
+    if len(geometric[0]) >= INT64_MIN_BATCH:
+        # NumPy only picks an integer dtype if every weight is an integer that fits.
+        geometric_array, algebraic_array = np.array(geometric), np.array(algebraic)
+        if geometric_array.dtype.kind == 'i' and algebraic_array.dtype.kind == 'i':
+            geometric_array, algebraic_array = geometric_array.astype(np.int64), algebraic_array.astype(np.int64)
+            steps = int64_steps(program, position, max(int(np.abs(geometric_array).max()), int(np.abs(algebraic_array).max())), 3)
+            if steps > 0:
+                while steps > 0:
+                    geometric_array, algebraic_array = execute_int64(program[position:position+steps], geometric_array, algebraic_array)
+                    position += steps
+                    steps = int64_steps(program, position, max(int(np.abs(geometric_array).max()), int(np.abs(algebraic_array).max())), 3)
+                geometric, algebraic = geometric_array.tolist(), algebraic_array.tolist()
+    
+    for instruction in program[position:]:
+        opcode = instruction[0]
+        if opcode == FLIP:
+            _, a, b, c, d, e, sign_b, sign_c = instruction
+            geometric[e] = [(w + y if w + y >= x + z else x + z) - v for w, x, y, z, v in zip(geometric[a], geometric[b], geometric[c], geometric[d], geometric[e])]
+            algebraic[e] = [sign_b * x + sign_c * y for x, y in zip(algebraic[b], algebraic[c])]
+        elif opcode == ISOMETRY:
+            _, indices, signs = instruction
+            geometric[:] = [geometric[i] for i in indices]
+            algebraic[:] = [algebraic[i] if sign == +1 else [-x for x in algebraic[i]] for i, sign in zip(indices, signs)]
+        else:  # opcode == APPLY:
+            move = instruction[1]
+            geometric = [list(row) for row in zip(*[move.apply_geometric(list(column)) for column in zip(*geometric)])]
+            algebraic = [list(row) for row in zip(*[move.apply_algebraic(list(column)) for column in zip(*algebraic)])]
+    
+    return geometric, algebraic
+
 class Move(object):
     ''' This represents an abstract move between triangulations and provides the framework for subclassing. '''
     def __init__(self, source_triangulation, target_triangulation):
@@ -47,6 +197,14 @@ class Move(object):
         ''' Return the Encoding induced by this isometry. '''
         
         return flipper.kernel.Encoding([self])
+    
+    def compile(self):
+        ''' Return a tuple of instructions describing the action of this move on weights.
+        
+        See execute() for how these are applied. Moves without a more efficient
+        description fall back to calling apply_geometric and apply_algebraic. '''
+        
+        return ((APPLY, self),)
 
 class Isometry(Move):
     ''' This represents an isometry from one Triangulation to another.
@@ -97,6 +255,14 @@ class Isometry(Move):
     def apply_algebraic(self, vector):
         return [vector[self.inverse_index_map[i]] * self.inverse_signs[i] for i in range(self.zeta)]
     
+    def compile(self):
+        indices = tuple(self.inverse_index_map[i] for i in range(self.zeta))
+        signs = tuple(self.inverse_signs[i] for i in range(self.zeta))
+        if indices == tuple(range(self.zeta)) and all(sign == +1 for sign in signs):
+            return tuple()  # The identity isometry does not change any weights.
+        
+        return ((ISOMETRY, indices, signs),)
+    
     def inverse(self):
         ''' Return the inverse of this isometry. '''
         
@@ -187,6 +353,10 @@ class EdgeFlip(Move):
         m = b.sign() * vector[b.index] + c.sign() * vector[c.index]
         return [vector[i] if i != self.edge_index else m for i in range(self.zeta)]
     
+    def compile(self):
+        a, b, c, d = self.square
+        return ((FLIP, a.index, b.index, c.index, d.index, self.edge_index, b.sign(), c.sign()),)
+    
     def inverse(self):
         ''' Return the inverse of this map. '''
         
@@ -202,13 +372,15 @@ class EdgeFlip(Move):
         
         a, b, c, d, e = [edge.index for edge in self.square] + [self.edge_index]
         
-        rows = [list(row) for row in action]
+        # Only row e of the action matrix changes so we only build that row. Note that
+        # the width of action need not be zeta if there was a LinearTransformation earlier.
+        rows = list(action)
         if lamination(a) + lamination(c) >= lamination(b) + lamination(d):
-            rows[e] = [rows[a][i] + rows[c][i] - rows[e][i] for i in range(self.zeta)]
-            Cs = flipper.kernel.Matrix([[action[a][i] + action[c][i] - action[b][i] - action[d][i] for i in range(self.zeta)]])
+            rows[e] = [w + y - v for w, y, v in zip(action[a], action[c], action[e])]
+            Cs = flipper.kernel.Matrix([[w + y - x - z for w, x, y, z in zip(action[a], action[b], action[c], action[d])]])
         else:
-            rows[e] = [rows[b][i] + rows[d][i] - rows[e][i] for i in range(self.zeta)]
-            Cs = flipper.kernel.Matrix([[action[b][i] + action[d][i] - action[a][i] - action[c][i] for i in range(self.zeta)]])
+            rows[e] = [x + z - v for x, z, v in zip(action[b], action[d], action[e])]
+            Cs = flipper.kernel.Matrix([[x + z - w - y for w, x, y, z in zip(action[a], action[b], action[c], action[d])]])
         return flipper.kernel.Matrix(rows), Cs
     
     def pl_action(self, index, action):
@@ -221,13 +393,13 @@ class EdgeFlip(Move):
         
         a, b, c, d, e = [edge.index for edge in self.square] + [self.edge_index]
         
-        rows = [list(row) for row in action]
+        rows = list(action)
         if index == 0:
-            rows[e] = [rows[a][i] + rows[c][i] - rows[e][i] for i in range(self.zeta)]
-            Cs = flipper.kernel.Matrix([[action[a][i] + action[c][i] - action[b][i] - action[d][i] for i in range(self.zeta)]])
+            rows[e] = [w + y - v for w, y, v in zip(action[a], action[c], action[e])]
+            Cs = flipper.kernel.Matrix([[w + y - x - z for w, x, y, z in zip(action[a], action[b], action[c], action[d])]])
         elif index == 1:
-            rows[e] = [rows[b][i] + rows[d][i] - rows[e][i] for i in range(self.zeta)]
-            Cs = flipper.kernel.Matrix([[action[b][i] + action[d][i] - action[a][i] - action[c][i] for i in range(self.zeta)]])
+            rows[e] = [x + z - v for x, z, v in zip(action[b], action[d], action[e])]
+            Cs = flipper.kernel.Matrix([[x + z - w - y for w, x, y, z in zip(action[a], action[b], action[c], action[d])]])
         else:
             raise IndexError('Index out of range.')
         return flipper.kernel.Matrix(rows), Cs
@@ -312,6 +484,170 @@ class EdgeFlip(Move):
         
         return tetra_count+1, self.target_triangulation, new_upper_map, new_lower_map
 
+class Spiral(Move):
+    ''' Represents the change to a lamination caused by twisting about the core curve of an annulus.
+    
+    The annulus is the square about edge_label, whose sides b and d must be the same edge.
+    Twisting once is the same as flipping edge_label and then swapping it with b. However
+    the action of power such twists on weights is computed in closed form and so its cost
+    does not depend on power. '''
+    def __init__(self, source_triangulation, target_triangulation, edge_label, power):
+        super(Spiral, self).__init__(source_triangulation, target_triangulation)
+        assert isinstance(edge_label, flipper.IntegerType)
+        assert isinstance(power, flipper.IntegerType)
+        
+        self.flip_length = abs(power)  # The number of flips needed to realise this move.
+        self.edge_label = edge_label
+        self.edge_index = flipper.kernel.norm(self.edge_label)
+        self.power = power
+        
+        self.square = self.source_triangulation.square_about_edge(self.edge_label)
+        a, b, c, d = self.square
+        if b.index != d.index:
+            raise flipper.AssumptionError('Edge %d is not the diagonal of an annulus.' % self.edge_label)
+        self.core_index = b.index
+        
+        # The moves realising a single twist, in the order in which they act.
+        flipped = self.source_triangulation.flip_edge(self.edge_label)
+        flip = EdgeFlip(self.source_triangulation, flipped, self.edge_label)
+        isometry = flipped.find_isometry(self.target_triangulation, dict((i, i) for i in self.source_triangulation.indices if i not in [self.edge_index, self.core_index]))
+        self.steps = [flip, isometry] if self.power >= 0 else [isometry.inverse(), flip.inverse()]
+        
+        # Only the weights of the edges of the annulus change and the algebraic ones do so linearly.
+        self.annulus = sorted(set([self.edge_index, self.core_index, a.index, c.index]))
+        columns = []
+        for j in self.annulus:
+            vector = [1 if i == j else 0 for i in range(self.zeta)]
+            for move in self.steps:
+                vector = move.apply_algebraic(vector)
+            columns.append([vector[i] for i in self.annulus])
+        self.algebraic = flipper.kernel.Matrix(columns).transpose()**abs(self.power)
+    
+    def __str__(self):
+        return 'Spiral %s%d^%d' % ('' if self.edge_index == self.edge_label else '~', self.edge_index, self.power)
+    def __reduce__(self):
+        return (self.__class__, (self.source_triangulation, self.target_triangulation, self.edge_label, self.power))
+    def __len__(self):
+        return max(2 * abs(self.power), 1)  # The number of pieces of this move.
+    def package(self):
+        ''' Return a small amount of data such that self.source_triangulation.encode([data]) == self.encode(). '''
+        
+        return (self.edge_label, self.power)
+    
+    def _runs(self, x, y, length):
+        ''' Return the runs of branches taken when twisting with weights x and y on the edges
+        of the annulus and length = a + c, along with the resulting weights.
+        
+        A twist takes (x, y) to (y, max(2y, length) - x) and each run is a pair (branch, m)
+        recording that m consecutive twists used 2y (branch == True) or length (branch == False).
+        When power < 0 we twist backwards, which is the same as doing this with x and y swapped.
+        Apart from at most two twists using length, the twists form two arithmetic progressions
+        which we jump over in one go. '''
+        
+        if self.power < 0: x, y = y, x
+        runs = []
+        k = abs(self.power)
+        while k > 0:
+            if 2 * y >= length:
+                difference = y - x
+                # If the weights are decreasing then we can only go until 2y < length.
+                m = k if difference >= 0 else min(k, (2 * y - length) // (-2 * difference) + 1)
+                x, y = x + m * difference, y + m * difference
+                runs.append((True, m))
+            else:
+                m = 1
+                x, y = y, length - x
+                runs.append((False, m))
+            k -= m
+        if self.power < 0: x, y = y, x
+        
+        return runs, x, y
+    
+    def _cell(self, runs, action):
+        ''' Return the action and condition matrices of the cell where twisting takes the given runs of branches. '''
+        
+        a, b, c, d = self.square  # pylint: disable=unused-variable
+        rows = list(action)
+        X, Y = action[self.edge_index], action[self.core_index]
+        if self.power < 0: X, Y = Y, X
+        length = [w + y for w, y in zip(action[a.index], action[c.index])]
+        conditions = []
+        for branch, m in runs:
+            if branch:
+                # Each twist adds Y - X to both X and Y. As this is linear, 2Y >= length
+                # holds for all m of these twists iff it holds for the first and last.
+                difference = [y - x for x, y in zip(X, Y)]
+                conditions.append([2 * y - l for y, l in zip(Y, length)])
+                conditions.append([2 * (y + (m - 1) * z) - l for y, z, l in zip(Y, difference, length)])
+                X, Y = [x + m * z for x, z in zip(X, difference)], [y + m * z for y, z in zip(Y, difference)]
+            else:
+                conditions.append([l - 2 * y for y, l in zip(Y, length)])
+                X, Y = Y, [l - x for x, l in zip(X, length)]
+        if self.power < 0: X, Y = Y, X
+        rows[self.edge_index], rows[self.core_index] = X, Y
+        
+        return flipper.kernel.Matrix(rows), flipper.kernel.Matrix(conditions) if conditions else flipper.kernel.zero_matrix(0)
+    
+    def apply_geometric(self, vector):
+        a, b, c, d = self.square  # pylint: disable=unused-variable
+        _, x, y = self._runs(vector[self.edge_index], vector[self.core_index], vector[a.index] + vector[c.index])
+        return [x if i == self.edge_index else y if i == self.core_index else vector[i] for i in range(self.zeta)]
+    
+    def apply_algebraic(self, vector):
+        image = self.algebraic([vector[i] for i in self.annulus])
+        vector = list(vector)
+        for i, value in zip(self.annulus, image):
+            vector[i] = value
+        return vector
+    
+    def inverse(self):
+        ''' Return the inverse of this map. '''
+        
+        return Spiral(self.target_triangulation, self.source_triangulation, self.edge_label, -self.power)
+    
+    def applied_geometric(self, lamination, action):
+        ''' Return the action and condition matrices describing the PL map
+        applied to the geometric coordinates of the given lamination after
+        post-multiplying by the action matrix. '''
+        
+        assert isinstance(lamination, flipper.kernel.Lamination)
+        assert isinstance(action, flipper.kernel.Matrix)
+        
+        a, b, c, d = self.square  # pylint: disable=unused-variable
+        runs, _, _ = self._runs(lamination(self.edge_index), lamination(self.core_index), lamination(a) + lamination(c))
+        return self._cell(runs, action)
+    
+    def pl_action(self, index, action):
+        ''' Return the action and condition matrices describing the PL map
+        applied to the geometric coordinates by the cell of the specified index
+        after post-multiplying by the action matrix. '''
+        
+        assert isinstance(index, flipper.IntegerType)
+        assert isinstance(action, flipper.kernel.Matrix)
+        
+        # The cells are the ones where the twists use 2y, then use length once or twice
+        # after p of them and then use 2y for the rest. The first cell never uses length.
+        k = abs(self.power)
+        if not 0 <= index < len(self):
+            raise IndexError('Index out of range.')
+        elif index == 0:
+            runs = [(True, k)]
+        else:
+            p, r = divmod(index - 1, 2)
+            runs = [(True, p)] + [(False, 1)] * (r + 1) + [(True, k - p - r - 1)]
+        
+        return self._cell([(branch, m) for branch, m in runs if m > 0], action)
+    
+    def extend_bundle(self, triangulation3, tetra_count, upper_triangulation, lower_triangulation, upper_map, lower_map):  # pylint: disable=too-many-arguments
+        ''' Modify triangulation3 to extend the embedding of upper_triangulation via upper_map under this move. '''
+        
+        # Each twist needs its own tetrahedron so we just layer on the moves of each twist in turn.
+        for _ in range(abs(self.power)):
+            for move in self.steps:
+                tetra_count, upper_triangulation, upper_map, lower_map = move.extend_bundle(triangulation3, tetra_count, upper_triangulation, lower_triangulation, upper_map, lower_map)
+        
+        return tetra_count, self.target_triangulation, upper_map, lower_map
+
 class LinearTransformation(Move):
     ''' Represents the change to a lamination caused by a linear map. '''
     def __init__(self, source_triangulation, target_triangulation, geometric, algebraic):
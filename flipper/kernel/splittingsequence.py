@@ -1,10 +1,26 @@
 
 ''' A module for representing a splitting sequence of a lamination.
 
-Provides one class: SplittingSequence. '''
+Provides three classes: SplittingSequence, SplittingSequences and SplittingSearch. '''
+
+import heapq
+import os
+import pickle
+import time
 
 import flipper
 
+try:
+    replace_file = os.replace
+except AttributeError:  # Python 2.
+    def replace_file(source, target):
+        ''' Rename source to target, overwriting target if it exists. '''
+        
+        # Only POSIX allows rename to overwrite an existing file.
+        if os.name == 'nt' and os.path.exists(target):
+            os.remove(target)
+        os.rename(source, target)
+
 class SplittingSequence(object):
     ''' This represents a sequence of flips of an Triangulation. '''
     def __init__(self, preperiodic, mapping_class, dilatation, lamination):
@@ -47,9 +63,354 @@ class SplittingSequences(object):
         
         self.preperiodic = self.encoding[-self.index:]
         self.open_periodic = self.encoding[:-self.index]
+        # These can be very long so only keep their packages rather than every triangulation they pass through.
+        for encoding in [self.encoding, self.preperiodic, self.open_periodic]:
+            encoding.compress()
     
     def __iter__(self):
         for isometry in self.isometries:
             # We will reverse the direction of self.mapping_class so that self.lamination is the stable lamination.
-            yield SplittingSequence(self.preperiodic, (isometry.encode() * self.open_periodic).inverse(), self.dilatation, self.lamination)
+            mapping_class = (isometry.encode() * self.open_periodic).inverse()
+            mapping_class.compress()
+            yield SplittingSequence(self.preperiodic, mapping_class, self.dilatation, self.lamination)
+
+class SplittingSearch(object):
+    ''' This represents the search for the splitting sequences of a lamination.
+    
+    See Lamination.splitting_sequences for a description of this search. Unlike that
+    method, a SplittingSearch can be run for a limited amount of time and resumed
+    later. It can also periodically save its state to disk so that it can be resumed
+    by another process using SplittingSearch.load().
+    
+    If prepass is True then the search first splits interval approximations of the
+    weights to locate the round where the periodic part starts, see locate(). The exact
+    search then only looks for periodic laminations from that round onwards. This is off
+    by default since the exact search still does every flip and the checks that it skips
+    are already cheap, so it has not yet been found to be any faster.
+    
+    The progress of the search is given by num_flips, the number of flips done so
+    far, and by weight(), the weight of the current lamination which decreases.
+    The number of times that Lamination.projective_hash matched a lamination that
+    turned out not to be projectively isometric is recorded in num_collisions. '''
+    
+    # We will only ever look up laminations that occur in the last maxlen steps, which is at least
+    # the periodic length of the sequence. So we store the laminations in a bunch of dictionaries
+    # that we cycle through. This way their union will always contain the last maxlen indices and
+    # will only contain at most maxlen * NUM_LAM_BLOCKS / (NUM_LAM_BLOCKS - 1) laminations.
+    NUM_LAM_BLOCKS = 5
+    
+    # The pre-pass starts with weights accurate to ACCURACY decimal places and doubles
+    # this each time they run out of precision, up to MAX_ACCURACY. Approximate laminations
+    # are compared using KEY_DIGITS digits of their normalised weights and we require the
+    # weights to be known to KEY_DIGITS + GUARD_DIGITS significant figures.
+    ACCURACY = 50
+    MAX_ACCURACY = 1600
+    KEY_DIGITS = 10
+    GUARD_DIGITS = 10
+    
+    def __init__(self, lamination, dilatation=None, maxlen=None, prepass=False):
+        assert isinstance(lamination, flipper.kernel.Lamination)
+        
+        self.dilatation = dilatation
+        self.maxlen = maxlen
+        self.start_triangulation = lamination.triangulation
+        self.result = None  # The SplittingSequences, once they have been found.
+        
+        # We should call lamination.collapse_trivial_weight(flip_index) on each
+        # weight 0 edge and rely on it to either collapse the edge or raise the
+        # approprate error.
+        
+        # Puncture all the triangles where the lamination is a tripod.
+        self.start_encoding = lamination.puncture_tripods()
+        self.start_lamination = self.start_encoding(lamination)
+        self.reset(self.locate() if prepass else 0)
+    
+    def reset(self, window):
+        ''' Start the exact search again, only looking for periodic laminations from the given round onwards. '''
+        
+        self.window = window
+        self.first_index = None  # The index of the first lamination that we record.
+        
+        self.encodings = [self.start_encoding]
+        self.lamination = self.start_lamination
+        self.created = False  # Whether this search built the triangulation of self.lamination.
+        self.before_window = self.lamination if self.window > 0 else None  # The lamination in the round before the window.
+        self.num_flips = 0
+        self.num_rounds = 0
+        self.num_collisions = 0
+        
+        # This is a dict taking the hash of each lamination to the indices where we saw it.
+        self.seen = dict()
+        # We then want a second dictionary taking indices where laminations occur back to the
+        # lamination. This can use a lot of memory however as Tao's K(S) can grow very large
+        # when the surface has high genus. So we split it into blocks, see NUM_LAM_BLOCKS.
+        self.laminations = [dict() for _ in range(self.NUM_LAM_BLOCKS)]
+        self.current_block = 0  # This records which dictionary we are currently filling.
+        if self.window == 0:
+            self.record()
+        
+        # We'll store the edge weights in a maximal heap using heapq. This allows us to quickly find the maximal weight edges.
+        self.weights_heap = [(-weight, index) for index, weight in enumerate(self.lamination)]
+        heapq.heapify(self.weights_heap)
+        # Get the largest weight edge.
+        self.next_flip = self.pop_heaviest()
+    
+    def __repr__(self):
+        return str(self)
+    def __str__(self):
+        return 'SplittingSearch after %d flips' % self.num_flips
+    
+    def pop_heaviest(self):
+        ''' Remove and return the (weight, index) of an edge of maximal weight from the heap. '''
+        
+        weight, index = heapq.heappop(self.weights_heap)
+        return -weight, index
+    
+    def weight(self):
+        ''' Return the weight of the current lamination. '''
+        
+        return self.lamination.weight()
+    
+    def locate(self):
+        ''' Return the number of rounds of splitting before the start lamination appears to become projectively periodic.
+        
+        This runs the splitting on interval approximations of the weights, which is
+        much cheaper than using exact arithmetic, and doubles their accuracy whenever
+        they are too imprecise. If an edge of weight 0 appears then this stops and
+        returns the round in which it does. Returns 0 if the weights cannot be made
+        accurate enough.
+        
+        Ties between approximate weights are assumed to be exact and so the answer is
+        not guaranteed. However step() checks that the periodic part found does not
+        start before this round and otherwise starts the search again from round 0. '''
+        
+        accuracy = self.ACCURACY
+        while accuracy <= self.MAX_ACCURACY:
+            rounds = self.locate_with_accuracy(accuracy)
+            if rounds is not None:
+                return rounds
+            accuracy *= 2
+        
+        return 0
+    
+    def locate_with_accuracy(self, accuracy):
+        ''' Return locate() computed using weights accurate to the given number of decimal places.
+        
+        Returns None if the weights run out of precision. '''
+        
+        # Each weight is approximated by an interval [lower / scale, upper / scale].
+        scale = 10**accuracy
+        triangulation = self.start_lamination.triangulation
+        weights = self.start_lamination.approximate_weights(accuracy)
+        if self.dilatation is None:
+            dilatation = None
+        elif isinstance(self.dilatation, flipper.kernel.RealAlgebraic):
+            interval = self.dilatation.interval(accuracy).simplify(accuracy)
+            dilatation = (interval.lower, interval.upper)
+        else:
+            dilatation = (self.dilatation * scale, self.dilatation * scale)
+        key_scale, guard_scale = 10**self.KEY_DIGITS, 10**(self.KEY_DIGITS + self.GUARD_DIGITS)
+        
+        seen = dict()
+        rounds = []  # The triangulation, weights and total weight of the lamination in each round.
+        while True:
+            total = (sum(lower for lower, _ in weights), sum(upper for _, upper in weights))
+            
+            # Check if we have (approximately) seen this lamination before using the
+            # same sort of hash as Lamination.projective_hash.
+            L = [(lower + upper) * key_scale // (total[0] + total[1]) for lower, upper in weights]
+            triples = [tuple([L[edge.index] for edge in triangle]) for triangle in triangulation]
+            target = tuple(sorted([min(triple[i:] + triple[:i] for i in range(len(triple))) for triple in triples]))
+            for index in seen.get(target, []):
+                old_triangulation, old_weights, old_total = rounds[index]
+                if dilatation is not None and (old_total[1] * scale < dilatation[0] * total[0] or dilatation[1] * total[1] < old_total[0] * scale):
+                    continue  # The weights do not differ by the dilatation.
+                
+                for isometry in triangulation.isometries_to(old_triangulation):
+                    # Check whether old_weights[isometry(i)] / old_total and weights[i] / total can be equal.
+                    image = isometry.index_map
+                    if all(old_weights[image[i]][0] * total[0] <= weights[i][1] * old_total[1] and weights[i][0] * old_total[0] <= old_weights[image[i]][1] * total[1] for i in triangulation.indices):
+                        return index
+            seen.setdefault(target, []).append(len(rounds))
+            rounds.append((triangulation, weights, total))
+            
+            # Split all of the branches that might have maximal weight. These are flipped in
+            # order of their index, just as in step().
+            max_lower = max(lower for lower, _ in weights)
+            weights = list(weights)
+            for flip_index in [index for index, (_, upper) in enumerate(weights) if upper >= max_lower]:
+                a, b, c, d = triangulation.square_about_edge(flip_index)
+                lower = max(weights[a.index][0] + weights[c.index][0], weights[b.index][0] + weights[d.index][0]) - weights[flip_index][1]
+                upper = max(weights[a.index][1] + weights[c.index][1], weights[b.index][1] + weights[d.index][1]) - weights[flip_index][0]
+                if (upper - lower) * guard_scale >= lower:
+                    # Either this weight is (approximately) 0, or we have run out of precision.
+                    if lower <= 0 and (upper - lower) * guard_scale < weights[flip_index][0]:
+                        # The exact search will collapse this edge. As this changes the number of
+                        # edges, no earlier lamination can be projectively isometric to a later one.
+                        return len(rounds)
+                    return None
+                weights[flip_index] = (lower, upper)
+                triangulation = triangulation.flip_edge(flip_index)
+    
+    def record(self):
+        ''' Record the current lamination in the dictionary of seen laminations. '''
+        
+        index = len(self.encodings)
+        if self.first_index is None: self.first_index = index
+        
+        # To cut down on memory usage we will only retain the last maxlen laminations
+        # at any given point.
+        if self.maxlen is not None and len(self.laminations[self.current_block]) > self.maxlen // (self.NUM_LAM_BLOCKS - 1):
+            # Move to the (cyclically) next block and reset it with just this lamination.
+            self.current_block = (self.current_block + 1) % self.NUM_LAM_BLOCKS
+            self.laminations[self.current_block] = {index: self.lamination}
+        else:
+            self.laminations[self.current_block][index] = self.lamination
+        
+        self.seen.setdefault(self.lamination.projective_hash(), []).append(index)
+    
+    def step(self):
+        ''' Split all of the branches of maximal weight.
+        
+        Return the SplittingSequences if this reaches a projectively periodic
+        lamination (with the required dilatation) and None otherwise. '''
+        
+        if self.result is not None: return self.result
+        
+        previous = self.lamination
+        flip_weight, flip_index = self.next_flip
+        max_weight = flip_weight
+        # Flip all edges weight max_weight. As the heap outputs these in sorted order,
+        # we do this by popping an element and flipping it until we reach one of
+        # weight < max_weight.
+        while flip_weight == max_weight:
+            # Do the flip. If this edge has been flipped before then its result may be in use elsewhere.
+            created = flip_index not in self.lamination.triangulation._flips
+            E = self.lamination.triangulation.encode_flip(flip_index)
+            self.lamination = E(self.lamination)
+            # Record information about the flip.
+            self.encodings.append(E)
+            self.num_flips += 1
+            # Long sequences pass through a great many triangulations so only keep the compact form of them.
+            # We only do this to the ones that this search built as compressing any others would just
+            # force whoever else is using them to rebuild them.
+            if self.created: E.source_triangulation.compress()
+            self.created = created
+            
+            # Check if we have created any edges of weight 0. Of course it is enough to just check flip_index.
+            if self.lamination(flip_index) == 0:
+                try:
+                    # If this fails it's because the lamination isn't filling.
+                    self.lamination, E = self.lamination.collapse_trivial_weight(flip_index)
+                    self.encodings.append(E)
+                    self.created = True
+                    # Need to rebuild the heap as indices no longer correspond.
+                    self.weights_heap = [(-weight, index) for index, weight in enumerate(self.lamination)]
+                    heapq.heapify(self.weights_heap)
+                except flipper.AssumptionError:
+                    raise flipper.AssumptionError('Lamination is not filling.')
+            else:
+                # Add the new edge weight back into the heap.
+                heapq.heappush(self.weights_heap, (-self.lamination(flip_index), flip_index))
+            
+            # Get the next largest edge.
+            flip_weight, flip_index = self.pop_heaviest()
+        self.next_flip = (flip_weight, flip_index)
+        self.num_rounds += 1
+        
+        if self.num_rounds < self.window:
+            # The periodic part does not start yet so there is no need to look for it.
+            self.before_window = self.lamination
+            return None
+        
+        # Check if lamination now (projectively) matches a lamination we've already seen.
+        target = self.lamination.projective_hash()
+        for index in self.seen.get(target, []):
+            for block in self.laminations:
+                if index in block:
+                    old_lamination = block[index]
+                    break
+            else:
+                # This index has moved out of the lamination dictionaries and so is
+                # too old to be the start point of the periodic cycle.
+                continue
+            
+            # In the next block we have a lot of tests to do. We'll do these in
+            # order of difficulty of computation. For example, computing
+            # projective_isometries is slow; so we'll leave that to last to give
+            # us the best chance that a faster test failing will allow us to
+            # skip it.
+            if self.dilatation is None or old_lamination.weight() >= self.dilatation * self.lamination.weight():
+                isometries = self.lamination.all_projective_isometries(old_lamination)
+                if isometries:
+                    assert self.dilatation is None or old_lamination.weight() == self.dilatation * self.lamination.weight()
+                    
+                    if index == self.first_index and self.before_window is not None and self.periodic(previous, self.before_window):
+                        # The periodic part actually started before the window, which happens
+                        # only if locate() was misled by its approximations.
+                        self.reset(0)
+                        return None
+                    
+                    encoding = flipper.kernel.Encoding([move for item in reversed(self.encodings) for move in item])
+                    self.result = SplittingSequences(encoding, isometries, index, self.dilatation, old_lamination)
+                    return self.result
+                self.num_collisions += 1
+            else:
+                # dilatation is not None and:
+                #   old_lamination.weight() < dilatation * lamination.weight():
+                # Note that the weight of laminations is strictly decreasing and the
+                # indices of seen[target] are increasing. Thus if we are in this case
+                # then the same inequality holds for every later index in seen[target].
+                # Hence we may break out.
+                break
+        
+        self.record()
+        
+        return None
+    
+    def periodic(self, lamination, old_lamination):
+        ''' Return whether lamination is projectively isometric to old_lamination (with the required dilatation). '''
+        
+        if self.dilatation is not None and old_lamination.weight() != self.dilatation * lamination.weight():
+            return False
+        
+        return bool(lamination.all_projective_isometries(old_lamination))
+    
+    def run(self, time_limit=None, checkpoint=None, checkpoint_interval=600):
+        ''' Run this search and return the SplittingSequences found.
+        
+        If time_limit is given then stop after roughly this many seconds and return
+        None if the search has not finished. Running again resumes the search.
+        
+        If checkpoint is given then the state of this search is saved to this path
+        every checkpoint_interval seconds and whenever the time limit is reached. '''
+        
+        start = last_save = time.time()
+        while self.step() is None:
+            now = time.time()
+            if checkpoint is not None and now - last_save >= checkpoint_interval:
+                self.save(checkpoint)
+                last_save = now
+            if time_limit is not None and now - start >= time_limit:
+                if checkpoint is not None: self.save(checkpoint)
+                return None
+        
+        return self.result
+    
+    def save(self, path):
+        ''' Save the state of this search to the given path. '''
+        
+        # Write to a temporary file first so that an interrupted save does not destroy the last checkpoint.
+        with open(path + '.tmp', 'wb') as handle:
+            pickle.dump(self, handle, protocol=pickle.HIGHEST_PROTOCOL)
+        replace_file(path + '.tmp', path)
+    
+    @classmethod
+    def load(cls, path):
+        ''' Return the search saved to the given path by SplittingSearch.save(). '''
+        
+        with open(path, 'rb') as handle:
+            search = pickle.load(handle)
+        assert isinstance(search, cls)
+        return search
 
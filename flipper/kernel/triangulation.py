@@ -7,19 +7,29 @@ Provides five classes: Vertex, Edge, Triangle, Corner and Triangulation.
     A Corner is a Triangle with a chosen side.
     A Triangulation is a collection of Triangles. '''
 
+from array import array
+from bisect import bisect
+from collections import Counter, deque
+import heapq
 from itertools import groupby
 from math import log
 from random import choice
 import string
-try:
-    from Queue import Queue
-except ImportError:
-    from queue import Queue
+from weakref import WeakValueDictionary
 
 import flipper
+from flipper.kernel.decorators import memoize  # Special import needed for decorating.
 
 INFTY = float('inf')
 
+# The triangulations built by flipping, keyed by their signature and vertex data. Equal
+# triangulations obtained by flipping are then the same object. As this only holds weak
+# references, triangulations are still freed once they are no longer used elsewhere.
+TRIANGULATIONS = WeakValueDictionary()
+
+# The attributes of a Triangulation that are released by Triangulation.compress().
+OBJECT_VIEW = ['triangles', 'edges', 'positive_edges', 'vertices', 'corners', 'triangle_lookup', 'edge_lookup', 'corner_lookup', 'vertex_lookup', 'corner_classes']
+
 def norm(value):
     ''' A map taking an edges label to its index.
     
@@ -285,7 +295,16 @@ class Triangulation(object):
             self.max_order = self.num_unfilled_vertices
         
         # Two triangualtions are the same if and only if they have the same signature.
-        self.signature = [e.label for t in self for e in t]
+        # This is also the table of the labels of the triangles.
+        self.signature = array('l', [e.label for t in self for e in t])
+        # We store the hash of the signature so that most unequal triangulations can be told apart in O(1).
+        self._hash = hash(tuple(self.signature))
+        
+        self._flips = WeakValueDictionary()  # Maps an edge label to the result of flipping it.
+        self._squares = dict()  # Maps an edge label to the square about it.
+        # These describe the vertices when compress() has released the objects, see compress().
+        self._corner_vertices = None
+        self._vertex_states = None
     
     @classmethod
     def from_tuple(cls, edge_labels, vertex_labels=None, vertex_states=None):
@@ -537,13 +556,55 @@ class Triangulation(object):
     def __reduce__(self):
         # Triangulations are already pickleable but this results in a much smaller pickle.
         return (create_triangulation, (self.__class__,) + self.package())
+    def __getattr__(self, name):
+        # This is only called when name is not already an attribute, for example
+        # after compress() has released the object view of this triangulation.
+        if name in OBJECT_VIEW and self._corner_vertices is not None:
+            self.expand()
+            return getattr(self, name)
+        raise AttributeError(name)
     def __eq__(self, other):
-        return self.signature == other.signature
+        if isinstance(other, Triangulation):
+            return self is other or (self._hash == other._hash and self.signature == other.signature)
+        else:
+            return NotImplemented
     def __ne__(self, other):
         return not self == other
+    def __hash__(self):
+        return self._hash
     def __call__(self, geometric, algebraic=None, remove_peripheral=True):
         return self.lamination(geometric, algebraic, remove_peripheral)
     
+    def compress(self):
+        ''' Release the Vertices, Edges, Triangles and Corners of this triangulation and the lookups between them.
+        
+        Only integer arrays describing this triangulation are kept and the objects are
+        rebuilt from these the next time that they are used. This makes it much cheaper
+        to keep many triangulations in memory. '''
+        
+        if self._corner_vertices is not None: return  # Already compressed.
+        
+        # The ith entry of these is the vertex at the corner labelled self.signature[i].
+        self._corner_vertices = array('l', [corner.vertex.label for corner in self.corners])
+        self._vertex_states = array('b', [vertex.filled for vertex in self.vertices])
+        for name in OBJECT_VIEW:
+            del self.__dict__[name]
+        self._squares = dict()
+    
+    def expand(self):
+        ''' Rebuild the objects of this triangulation released by compress(). '''
+        
+        if self._corner_vertices is None: return  # Not compressed.
+        
+        triangles = [self.signature[i:i+3].tolist() for i in range(0, len(self.signature), 3)]
+        vertex_labels = dict(zip(self.signature, self._corner_vertices))
+        vertex_states = dict(zip(sorted(set(self._corner_vertices)), [bool(state) for state in self._vertex_states]))
+        T = Triangulation.from_tuple(triangles, vertex_labels, vertex_states)
+        for name in OBJECT_VIEW:
+            setattr(self, name, getattr(T, name))
+        self._corner_vertices = None
+        self._vertex_states = None
+    
     def vertices_of_edge(self, edge_label):
         ''' Return the two vertices at the ends of the given edge. '''
         
@@ -583,6 +644,7 @@ class Triangulation(object):
         
         return self.corner_of_edge(corner.labels[1])
     
+    @memoize
     def iso_sig(self, preserve_orientation=False, skip=None, start_points=None):
         ''' Return the isomorphism signature of this triangulation as described by Ben Burton.
         
@@ -598,16 +660,36 @@ class Triangulation(object):
         (edge_lable, oriented) which specifies a corner to start with and whether
         to orient this corner to match the orientation of the triangle. This can
         be used to generate signatures relative to a fixed boundary by specify
-        an edge on that boundary (and True) as the only starting point. '''
+        an edge on that boundary (and True) as the only starting point.
+        
+        The signature is the least, over all starting points, of the sequences built by a
+        breadth first search. Each search is compared against the best found so far as it
+        is built and is abandoned as soon as it cannot beat it. '''
         
-        best = ([INFTY], [INFTY], [INFTY])
         skip = set() if skip is None else set(skip)
         
-        perm_inverse = flipper.kernel.permutation.PERM3_INVERSE
+        # To keep the searches cheap we work with the index of each permutation in PERM3.
+        perms = flipper.kernel.permutation.PERM3
         perm_lookup = flipper.kernel.permutation.PERM3_LOOKUP
-        transition_perm_lookup = flipper.kernel.permutation.TRANSITION_PERM3_LOOKUP
+        perm_inverse = [perm_lookup[perm.inverse()] for perm in perms]
+        perm_image = [[perm(i) for i in range(3)] for perm in perms]
+        perm_product = [[perm_lookup[perm * other] for other in perms] for perm in perms]
+        transition_perm_lookup = dict((key, perm_lookup[perm]) for key, perm in flipper.kernel.permutation.TRANSITION_PERM3_LOOKUP.items())
         perm_reverse = flipper.kernel.Permutation([0, 2, 1])
         
+        # Where each side of each triangle is glued to, or None if it is a boundary edge.
+        triangle_numbers = dict((triangle, index) for index, triangle in enumerate(self.triangles))
+        gluings = []
+        for triangle in self.triangles:
+            gluing = []
+            for side in range(3):
+                if ~triangle.labels[side] in skip:
+                    gluing.append(None)
+                else:
+                    target_corner = self.corner_of_edge(~triangle.labels[side])
+                    gluing.append((triangle_numbers[target_corner.triangle], target_corner.side))
+            gluings.append(gluing)
+        
         # Set up the starting points.
         if start_points is None:
             # If we want to preserve the orientation on the surface we should only use the positive
@@ -617,66 +699,103 @@ class Triangulation(object):
             else:
                 start_points = [(label, orientation) for label in self.labels for orientation in [True, False]]
         
+        starts = []
         for start_edge, start_orientation in start_points:
             start_corner = self.corner_lookup[start_edge]
-            start_triangle = start_corner.triangle
-            
-            if not all(label in skip for label in start_triangle.labels):
+            if not all(label in skip for label in start_corner.triangle.labels):
                 start_perm = flipper.kernel.permutation.cyclic_permutation(start_corner.side, 3).inverse()
                 if not start_orientation:
                     start_perm = start_perm * perm_reverse
+                starts.append((triangle_numbers[start_corner.triangle], perm_lookup[start_perm]))
+        
+        # The first entries of the type sequence only depend on how the starting triangle is glued
+        # to itself. So we only need to search from the starts where these are least.
+        def start_types(start):
+            ''' Return the start of the type sequence that the given start produces. '''
+            
+            triangle, perm = start
+            perm_inv = perm_inverse[perm]
+            types = []
+            for j in range(3):
+                side = perm_image[perm_inv][j]
+                if gluings[triangle][side] is None:
+                    types.append(0)
+                else:
+                    target_triangle, target_side = gluings[triangle][side]
+                    if target_triangle != triangle:
+                        types.append(1)
+                    elif perm_image[perm][target_side] > j:
+                        types.append(2)
+            return types
+        if starts:
+            least = min(start_types(start) for start in starts)
+            starts = [start for start in starts if start_types(start)[:len(least)] == least]
+        
+        best = ([INFTY], [INFTY], [INFTY])
+        for start_triangle, start_perm in starts:
+            best_types, best_targets, best_perms = best
+            type_sequence = []
+            target_sequence = []
+            permutation_sequence = []
+            
+            # Whether type_sequence is known to be less than best_types, otherwise it agrees with it so far,
+            # and how target_sequence and permutation_sequence compare with best so far (-1, 0 or +1).
+            less = False
+            target_cmp = perm_cmp = 0
+            
+            good = True
+            queue = deque([start_triangle])
+            triangle_labels = {start_triangle: (0, start_perm)}
+            num_triangles_seen = 1
+            
+            while queue and good:
+                triangle = queue.popleft()
+                triangle_index, perm = triangle_labels[triangle]
+                perm_inv = perm_inverse[perm]
                 
-                type_sequence = []
-                target_sequence = []
-                permutation_sequence = []
-                
-                good = True
-                queue = Queue()
-                queue.put(start_triangle)
-                triangle_labels = {start_triangle: (0, start_perm)}
-                num_triangles_seen = 1
-                
-                while not queue.empty() and good:
-                    triangle = queue.get()
-                    _, perm = triangle_labels[triangle]
-                    perm_inv = perm_inverse[perm]
-                    
-                    for j in range(3):
-                        side = perm_inv(j)
-                        target_corner = self.corner_of_edge(~triangle.labels[side])
-                        target_triangle = target_corner.triangle
-                        target_side = target_corner.side
-                        if ~triangle.labels[side] in skip:
-                            # This edge was really a boundary edge.
-                            type_sequence.append(0)
-                        elif target_triangle not in triangle_labels:
-                            target_perm = perm * transition_perm_lookup[(target_side, side)]
-                            triangle_labels[target_triangle] = (num_triangles_seen, target_perm)
-                            queue.put(target_triangle)
+                for j in range(3):
+                    side = perm_image[perm_inv][j]
+                    gluing = gluings[triangle][side]
+                    if gluing is None:
+                        # This edge was really a boundary edge.
+                        entry = 0
+                    else:
+                        target_triangle, target_side = gluing
+                        if target_triangle not in triangle_labels:
+                            triangle_labels[target_triangle] = (num_triangles_seen, perm_product[perm][transition_perm_lookup[(target_side, side)]])
+                            queue.append(target_triangle)
                             num_triangles_seen += 1
-                            
-                            type_sequence.append(1)
                             # We don't need to record the follow as they are implied.
-                            # target_sequence.append(len(queue))
-                            # permutation_sequence.append(perm_lookup[id_perm])
+                            entry = 1
                         else:
-                            triangle_index, _ = triangle_labels[triangle]
                             target_index, target_perm = triangle_labels[target_triangle]
-                            k = target_perm(target_side)
-                            if target_index > triangle_index or (target_index == triangle_index and k > j):
-                                # We've not done this gluing yet.
-                                transition_perm = target_perm * transition_perm_lookup[(side, target_side)] * perm_inv
-                                
-                                type_sequence.append(2)
-                                target_sequence.append(target_index)
-                                permutation_sequence.append(perm_lookup[transition_perm])
-                        # We can give up early if we've built something bigger than best.
-                        if type_sequence > best[0]:
+                            if target_index < triangle_index or (target_index == triangle_index and perm_image[target_perm][target_side] < j):
+                                continue  # We've already done this gluing.
+                            entry = 2
+                    
+                    # We can give up early if we've built something bigger than best.
+                    if not less:
+                        position = len(type_sequence)
+                        if position >= len(best_types) or entry > best_types[position]:
                             good = False
                             break
-                
-                if good:
-                    best = min((type_sequence, target_sequence, permutation_sequence), best)
+                        less = entry < best_types[position]
+                    type_sequence.append(entry)
+                    
+                    if entry == 2:
+                        transition_perm = perm_product[perm_product[target_perm][transition_perm_lookup[(side, target_side)]]][perm_inv]
+                        if not less:
+                            # As the type sequences agree so far, best has a target and permutation here too.
+                            position = len(target_sequence)
+                            if not target_cmp:
+                                target_cmp = (target_index > best_targets[position]) - (target_index < best_targets[position])
+                            if not perm_cmp:
+                                perm_cmp = (transition_perm > best_perms[position]) - (transition_perm < best_perms[position])
+                        target_sequence.append(target_index)
+                        permutation_sequence.append(transition_perm)
+            
+            if good and (less or len(type_sequence) < len(best_types) or (target_cmp or perm_cmp) < 0):
+                best = (type_sequence, target_sequence, permutation_sequence)
         
         char = string.ascii_lowercase + string.ascii_uppercase + string.digits + '+-'
         
@@ -745,13 +864,21 @@ class Triangulation(object):
         # V/    c     |
         # #---------->#
         
-        corner_A, corner_B = self.corner_of_edge(edge_label), self.corner_of_edge(~edge_label)
-        return [corner_A.edges[1], corner_A.edges[2], corner_B.edges[1], corner_B.edges[2]]
+        if edge_label not in self._squares:
+            corner_A, corner_B = self.corner_of_edge(edge_label), self.corner_of_edge(~edge_label)
+            self._squares[edge_label] = (corner_A.edges[1], corner_A.edges[2], corner_B.edges[1], corner_B.edges[2])
+        
+        return list(self._squares[edge_label])
     
     def flip_edge(self, edge_label):
         ''' Return a new triangulation obtained by flipping the given edge.
         
-        The chosen edge must be flippable. '''
+        The chosen edge must be flippable. Flipping the same edge of equal
+        triangulations returns the same object while it is still in use. '''
+        
+        flipped = self._flips.get(edge_label)
+        if flipped is not None:
+            return flipped
         
         assert self.is_flippable(edge_label)
         
@@ -770,26 +897,95 @@ class Triangulation(object):
         # V/    c     |     |          V|
         # #---------->#     #-----------#
         
-        vertex_map = dict()
-        for vertex in self.vertices:
-            vertex_map[vertex] = flipper.kernel.Vertex(vertex.label, filled=vertex.filled)
-        
-        edge_map = dict()
-        # Far away edges should go to an exact copy of themselves.
-        for edge in self.positive_edges:
-            edge_map[edge] = flipper.kernel.Edge(vertex_map[edge.source_vertex], vertex_map[edge.target_vertex], edge.label)
-            edge_map[~edge] = ~edge_map[edge]
-        
+        # Vertices, Edges and Triangles are never modified after they are created so
+        # the new triangulation can share all of the ones away from the flip with this one.
         a, b, c, d = self.square_about_edge(edge_label)
         # We need to label new_edge with norm(edge_label) so that self.flip_edge(i).flip_edge(~i) == self.
-        new_edge = Edge(vertex_map[a.target_vertex], vertex_map[c.target_vertex], norm(edge_label))
+        new_edge = Edge(a.target_vertex, c.target_vertex, norm(edge_label))
         
-        triangle_A2 = Triangle([new_edge, edge_map[d], edge_map[a]])
-        triangle_B2 = Triangle([~new_edge, edge_map[b], edge_map[c]])
+        triangle_A2 = Triangle([new_edge, d, a])
+        triangle_B2 = Triangle([~new_edge, b, c])
         
-        triangles = [flipper.kernel.Triangle([edge_map[edge] for edge in triangle]) for triangle in self if edge_label not in triangle.labels and ~edge_label not in triangle]
+        T = self.replace_triangles([self.triangle_lookup[edge_label], self.triangle_lookup[~edge_label]], [triangle_A2, triangle_B2])
         
-        return Triangulation(triangles + [triangle_A2, triangle_B2])
+        # The signature does not record the labels or states of the vertices so these are part of the key too.
+        key = (tuple(T.signature), tuple(corner.vertex.label for corner in T.corners), tuple(vertex.filled for vertex in T.vertices))
+        flipped = TRIANGULATIONS.setdefault(key, T)
+        self._flips[edge_label] = flipped
+        return flipped
+    
+    def replace_triangles(self, old_triangles, new_triangles):
+        ''' Return a new triangulation obtained by replacing old_triangles with new_triangles.
+        
+        The new triangles must use the same edge labels and meet the same vertices as the
+        old ones. This is the same as building Triangulation(triangles) from scratch but
+        it shares as much as it can with this triangulation. In particular only the corner
+        classes about the vertices of the new triangles are rebuilt. '''
+        
+        # Warning: This needs to be updated if the attributes set by Triangulation.__init__ ever change.
+        T = Triangulation.__new__(Triangulation)
+        
+        # Keep the triangles sorted by label, as in __init__.
+        triangles = [triangle for triangle in self if all(triangle is not old_triangle for old_triangle in old_triangles)]
+        keys = [triangle.labels for triangle in triangles]
+        for triangle in new_triangles:
+            position = bisect(keys, triangle.labels)
+            keys.insert(position, triangle.labels)
+            triangles.insert(position, triangle)
+        T.triangles = triangles
+        
+        T.edges = [edge for triangle in T for edge in triangle.edges]
+        T.positive_edges = [edge for edge in T.edges if edge.is_positive()]
+        T.labels = self.labels
+        T.indices = self.indices
+        T.vertices = self.vertices
+        T.corners = [corner for triangle in T for corner in triangle.corners]
+        
+        T.num_triangles = self.num_triangles
+        T.zeta = self.zeta
+        T.num_vertices = self.num_vertices
+        T.num_filled_vertices = self.num_filled_vertices
+        T.num_unfilled_vertices = self.num_unfilled_vertices
+        
+        T.triangle_lookup = dict(self.triangle_lookup)
+        T.edge_lookup = dict(self.edge_lookup)
+        T.corner_lookup = dict(self.corner_lookup)
+        T.vertex_lookup = dict(self.vertex_lookup)
+        for triangle in new_triangles:
+            for edge, corner in zip(triangle.edges, triangle.corners):
+                T.triangle_lookup[edge.label] = triangle
+                T.edge_lookup[edge.label] = edge
+                T.corner_lookup[corner.label] = corner
+                T.vertex_lookup[corner.label] = corner.vertex
+        
+        # Only the corner classes about the vertices of the new triangles can change.
+        # For these, we start at the first corner in T.corners, as __init__ would, and
+        # then walk anti-clockwise about the vertex.
+        changed_vertices = set(vertex.label for triangle in new_triangles for vertex in triangle.vertices)
+        T.corner_classes = []
+        for corner_class in self.corner_classes:
+            if corner_class[0].vertex.label in changed_vertices:
+                corners = [corner for corner in corner_class if all(corner.triangle is not old_triangle for old_triangle in old_triangles)]
+                corners += [corner for triangle in new_triangles for corner in triangle.corners if corner.vertex.label == corner_class[0].vertex.label]
+                ordered_class = [min(corners, key=lambda corner: (corner.triangle.labels, corner.side))]
+                for _ in range(len(corners)-1):
+                    ordered_class.append(T.corner_lookup[T.corner_lookup[~ordered_class[-1].labels[1]].labels[1]])
+                corner_class = ordered_class
+            T.corner_classes.append(corner_class)
+        
+        T.euler_characteristic = self.euler_characteristic
+        T.genus = self.genus
+        T.max_order = self.max_order
+        
+        T.signature = array('l', [e.label for t in T for e in t])
+        T._hash = hash(tuple(T.signature))
+        
+        T._flips = WeakValueDictionary()
+        T._squares = dict()
+        T._corner_vertices = None
+        T._vertex_states = None
+        
+        return T
     
     def relabel_edges(self, label_map):
         ''' Return a new triangulation obtained by relabelling the edges according to label_map. '''
@@ -823,6 +1019,7 @@ class Triangulation(object):
         triangles = [flipper.kernel.Triangle([edge_map[edge] for edge in triangle]) for triangle in self]
         return Triangulation(triangles)
     
+    @memoize
     def tree_and_dual_tree(self, respect_fillings=False):
         ''' Return a maximal tree in the 1--skeleton of this triangulation and a
         maximal tree in 1--skeleton of the dual of this triangulation.
@@ -831,9 +1028,35 @@ class Triangulation(object):
         No edge is used in both the tree and the dual tree. Note that when this surface
         is disconnected this tree is actually a forest. '''
         
+        def grow(used, ends):
+            ''' Grow a forest from the used nodes by repeatedly adding the edge of smallest index with exactly one used end.
+            
+            Ends maps the index of each edge that may be used to the pair of nodes that it connects. We
+            keep a heap of the edges meeting the used nodes, so this is Prim's algorithm with the edges
+            weighted by their index. '''
+            
+            incident = dict()
+            for edge_index, (a, b) in ends.items():
+                incident.setdefault(a, []).append(edge_index)
+                incident.setdefault(b, []).append(edge_index)
+            
+            forest = [False] * self.zeta
+            to_process = [edge_index for node in used if used[node] for edge_index in incident.get(node, [])]
+            heapq.heapify(to_process)
+            while to_process:
+                edge_index = heapq.heappop(to_process)
+                a, b = ends[edge_index]
+                if used[a] != used[b]:
+                    forest[edge_index] = True
+                    node = b if used[a] else a
+                    used[node] = True
+                    for new_edge_index in incident[node]:
+                        heapq.heappush(to_process, new_edge_index)
+            
+            return forest
+        
         components = self.components()
         
-        tree = [False] * self.zeta
         vertices_used = dict((vertex, False) for vertex in self.vertices)
         # Get some starting vertices.
         if respect_fillings:
@@ -848,37 +1071,17 @@ class Triangulation(object):
                         vertices_used[vertex] = True
                         break
         
-        while True:
-            for edge_index in range(self.zeta):
-                if not tree[edge_index]:
-                    a, b = self.vertices_of_edge(edge_index)
-                    if vertices_used[a] != vertices_used[b]:
-                        tree[edge_index] = True
-                        vertices_used[a] = True
-                        vertices_used[b] = True
-                        break
-            else:
-                break  # If there are no more to add then our tree is maximal.
+        tree = grow(vertices_used, dict((edge_index, self.vertices_of_edge(edge_index)) for edge_index in range(self.zeta)))
         
-        dual_tree = [False] * self.zeta
         faces_used = dict((triangle, False) for triangle in self.triangles)
         for component in components:
             faces_used[self.triangle_lookup[component[0]]] = True
         
-        while True:
-            for edge_index in range(self.zeta):
-                if not tree[edge_index] and not dual_tree[edge_index]:
-                    a, b = self.triangles_of_edge(edge_index)
-                    if faces_used[a] != faces_used[b]:
-                        dual_tree[edge_index] = True
-                        faces_used[a] = True
-                        faces_used[b] = True
-                        break
-            else:
-                break  # If there are no more to add then our dual tree is maximal.
+        dual_tree = grow(faces_used, dict((edge_index, self.triangles_of_edge(edge_index)) for edge_index in range(self.zeta) if not tree[edge_index]))
         
         return tree, dual_tree
     
+    @memoize
     def homology_basis(self):
         ''' Return a basis for H_1 of the underlying punctured surface.
         
@@ -891,65 +1094,100 @@ class Triangulation(object):
         # and a maximal spanning tree in the complement of the tree in the 1--skeleton of the dual triangulation.
         tree, dual_tree = self.tree_and_dual_tree()
         
-        # Generators are given by edges not in the tree or the dual tree (along with some segment
-        # in the dual tree to make it into a loop).
-        dual_tree_indices = [edge_index for edge_index in range(self.zeta) if dual_tree[edge_index]]
+        def crossing(edge_index, triangle):
+            ''' Return the label of the given edge when crossing it from the given triangle. '''
+            return edge_index if self.triangle_lookup[~edge_index] == triangle else ~edge_index
+        
+        # Root each component of the dual tree and record the parent of each triangle and the
+        # edge crossed to get there. This is a breadth first search.
+        neighbours = dict((triangle, []) for triangle in self.triangles)
+        for edge_index in range(self.zeta):
+            if dual_tree[edge_index]:
+                a, b = self.triangles_of_edge(edge_index)
+                neighbours[a].append((edge_index, b))
+                neighbours[b].append((edge_index, a))
+        
+        parent = dict()  # Mapping each triangle to its parent and the index of the edge between them.
+        depth = dict()
+        for root in self.triangles:
+            if root in depth: continue
+            parent[root], depth[root] = None, 0
+            to_process = deque([root])
+            while to_process:
+                current = to_process.popleft()
+                for edge_index, triangle in neighbours[current]:
+                    if triangle not in depth:
+                        parent[triangle], depth[triangle] = (current, edge_index), depth[current] + 1
+                        to_process.append(triangle)
+        
+        # Generators are given by edges not in the tree or the dual tree (along with the path
+        # in the dual tree between its sides to make it into a loop).
         homology_generators = []
         for edge_index in range(self.zeta):
             if not tree[edge_index] and not dual_tree[edge_index]:
-                generator = [~edge_index]
                 source, target = self.triangles_of_edge(edge_index)
                 
-                # Find a path in dual_tree from source to target. This is a really
-                # inefficient way to do this. We initially define the distance to
-                # each point to be self.num_triangles+1 which we know is larger than
-                # any possible distance.
-                distance = dict((triangle, self.num_triangles+1) for triangle in self.triangles)
-                distance[source] = 0
-                while distance[target] == self.num_triangles+1:
-                    for edge in dual_tree_indices:  # Only allowed to move in the tree.
-                        a, b = self.triangles_of_edge(edge)
-                        distance[a] = min(distance[b]+1, distance[a])
-                        distance[b] = min(distance[a]+1, distance[b])
-                
-                # Now find a way from the target back to the source by following the distance
-                current = target
-                while current != source:
-                    for edge in dual_tree_indices:
-                        a, b = self.triangles_of_edge(edge)
-                        if b == current and distance[a] == distance[b]-1:
-                            generator.append(edge)
-                            current = a
-                            break
-                        if a == current and distance[b] == distance[a]-1:
-                            generator.append(~edge)
-                            current = b
-                            break
+                # Walk from the target and the source up to where their paths to the root meet.
+                # This gives the path from target to source in two halves.
+                from_target, to_source = [], []
+                while target != source:
+                    if depth[target] >= depth[source]:
+                        previous, (target, index) = target, parent[target]
+                        from_target.append(crossing(index, previous))
+                    else:
+                        source, index = parent[source]
+                        to_source.append(crossing(index, source))
                 
                 # We've now made a generating loop.
-                homology_generators.append(generator)
+                homology_generators.append([~edge_index] + from_target + to_source[::-1])
         
         return homology_generators
     
-    def find_isometry(self, other, label_map, respect_fillings=True):
-        ''' Return the isometry from this triangulation to other defined by label_map.
-        
-        label_map must be a dictionary mapping self.labels to other.labels. Labels may
-        be omitted if they are determined by other given ones and these will be found
-        automatically.
-        
-        Assumes (and checks) that such an isometry exists and is unique. '''
+    @memoize
+    def corner_invariants(self, respect_fillings=True):
+        ''' Return a dictionary mapping each label to an invariant of the corner with that label.
+        
+        Any isometry must send each corner to one with the same invariant. We start with
+        the degree of each corner, the length of the zig-zag path through it and whether
+        its vertex is filled (if respect_fillings is True). We then repeatedly refine these
+        by the invariants of the neighbouring corners, as in the Weisfeiler--Lehman
+        algorithm, until they stop separating more corners. '''
+        
+        # The lengths of the zig-zag paths through each corner, which turn alternately left and
+        # right, separate corners even when there is only one vertex.
+        rotate = dict((label, self.corner_lookup[label].labels[1]) for label in self.labels)
+        zig_zag = dict((label, ~rotate[~rotate[rotate[label]]]) for label in self.labels)
+        zig_zags = dict()
+        for label in self.labels:
+            if label not in zig_zags:
+                path = [label]
+                while zig_zag[path[-1]] != label:
+                    path.append(zig_zag[path[-1]])
+                for x in path:
+                    zig_zags[x] = len(path)
+        invariants = dict((corner.label, hash((len(corner_class), respect_fillings and corner.vertex.filled, zig_zags[corner.label]))) for corner_class in self.corner_classes for corner in corner_class)
+        num_invariants = len(set(invariants.values()))
+        while num_invariants < len(invariants):
+            refined = dict((label, hash((invariants[label], invariants[~label], invariants[rotate[label]]))) for label in self.labels)
+            num_refined = len(set(refined.values()))
+            if num_refined <= num_invariants:
+                break
+            invariants, num_invariants = refined, num_refined
+        
+        return invariants
+    
+    def extend_label_map(self, other, label_map, source_invariants, target_invariants):
+        ''' Return label_map extended to an isometry from this triangulation to other or None if it does not extend.
         
-        assert isinstance(label_map, dict)
+        The extension must send each label to one with the same invariant, as given by
+        the source_invariants and target_invariants dictionaries. '''
         
         # Make a local copy as we may need to make a lot of changes.
         label_map = dict(label_map)
         
-        source_orders = dict((corner.label, len(corner_class)) for corner_class in self.corner_classes for corner in corner_class)
-        target_orders = dict((corner.label, len(corner_class)) for corner_class in other.corner_classes for corner in corner_class)
         # We do a depth first search extending the corner map across the triangulation.
         # This is a stack of labels that may still have consequences to check.
-        to_process = [(edge_from_label, label_map[edge_from_label]) for edge_from_label in label_map]
+        to_process = list(label_map.items())
         while to_process:
             from_label, to_label = to_process.pop()
             
@@ -961,16 +1199,35 @@ class Triangulation(object):
                 if new_from_label in label_map:
                     # Check that this map is still consistent.
                     if new_to_label != label_map[new_from_label]:
-                        raise flipper.AssumptionError('This label_map does not extend to an isometry.')
+                        return None
                 else:
                     # Extend the map.
-                    if source_orders[new_from_label] != target_orders[new_to_label] or respect_fillings and self.vertex_lookup[new_from_label].filled != other.vertex_lookup[new_to_label].filled:
-                        raise flipper.AssumptionError('This label_map does not extend to an isometry.')
+                    if source_invariants[new_from_label] != target_invariants[new_to_label]:
+                        return None
                     label_map[new_from_label] = new_to_label
                     to_process.append((new_from_label, new_to_label))
         
-        if any(i not in label_map for i in self.labels):
-            raise flipper.AssumptionError('This label_map cannot be extended to an isometry.')
+        if len(label_map) < len(self.labels):
+            return None
+        
+        return label_map
+    
+    def find_isometry(self, other, label_map, respect_fillings=True):
+        ''' Return the isometry from this triangulation to other defined by label_map.
+        
+        label_map must be a dictionary mapping self.labels to other.labels. Labels may
+        be omitted if they are determined by other given ones and these will be found
+        automatically.
+        
+        Assumes (and checks) that such an isometry exists and is unique. '''
+        
+        assert isinstance(label_map, dict)
+        
+        source_orders = dict((corner.label, (len(corner_class), respect_fillings and corner.vertex.filled)) for corner_class in self.corner_classes for corner in corner_class)
+        target_orders = dict((corner.label, (len(corner_class), respect_fillings and corner.vertex.filled)) for corner_class in other.corner_classes for corner in corner_class)
+        label_map = self.extend_label_map(other, label_map, source_orders, target_orders)
+        if label_map is None:
+            raise flipper.AssumptionError('This label_map does not extend to an isometry.')
         
         return flipper.kernel.Isometry(self, other, label_map)
     
@@ -985,22 +1242,29 @@ class Triangulation(object):
         
         # !?! This needs to be modified to work on disconnected surfaces.
         
-        # Isometries are determined by where a single triangle is sent.
-        # We take a corner of smallest degree.
-        source_cc = min(self.corner_classes, key=len)
-        source_corner = source_cc[0]
-        # And find all the places where it could be sent so there are as few as possible to check.
-        target_corners = [corner for target_cc in other.corner_classes for corner in target_cc if len(target_cc) == len(source_cc)]
+        source_invariants, target_invariants = self.corner_invariants(respect_fillings), other.corner_invariants(respect_fillings)
+        targets = dict()
+        for label in other.labels:
+            targets.setdefault(target_invariants[label], []).append(label)
+        if any(len(targets.get(invariant, [])) != count for invariant, count in Counter(source_invariants.values()).items()):
+            return []
         
+        # Isometries are determined by where a single corner is sent and it must be sent to
+        # a corner with the same invariant. So we start from the corner that has the fewest
+        # possible images.
+        source_label = min(self.labels, key=lambda label: (len(targets[source_invariants[label]]), label))
         isometries = []
-        for target_corner in target_corners:
-            try:
-                isometries.append(self.find_isometry(other, {source_corner.label: target_corner.label}, respect_fillings))
-            except flipper.AssumptionError:
-                pass
-        
-        return isometries
+        for target_label in targets[source_invariants[source_label]]:
+            label_map = self.extend_label_map(other, {source_label: target_label}, source_invariants, target_invariants)
+            if label_map is not None:
+                isometries.append(flipper.kernel.Isometry(self, other, label_map))
+        
+        # Return these in the order given by where the first corner of smallest degree goes.
+        source_corner = min(self.corner_classes, key=len)[0]
+        order = dict((corner.label, position) for position, corner in enumerate(corner for corner_class in other.corner_classes for corner in corner_class))
+        return sorted(isometries, key=lambda isometry: order[isometry.label_map[source_corner.label]])
     
+    @memoize
     def self_isometries(self):
         ''' Returns a list of isometries taking this triangulation to itself. '''
         
@@ -1084,11 +1348,16 @@ class Triangulation(object):
         c = h.target_triangulation.key_curves()[0]
         return h.inverse()(c)
     
+    @memoize
     def key_curves(self):
         ''' Return a list of curves which fill the underlying surface and include a basis for H_1(S).
         
         As these fill, by Alexander's trick a mapping class is the identity
-        if and only if it fixes all of them, including orientation. '''
+        if and only if it fixes all of them, including orientation.
+        
+        Building these is expensive and so, like homology_basis and tree_and_dual_tree,
+        they are computed once and cached on this triangulation. Callers must not modify
+        the list returned. '''
         
         curves = []
         
@@ -1194,6 +1463,7 @@ class Triangulation(object):
         several conventions that allow these to be specified by a smaller amount of information.
         
          - An integer x represents EdgeFlip(..., edge_label=x)
+         - A pair (x, k) represents Spiral(..., edge_label=x, power=k)
          - A dictionary which has i or ~i as a key (for every i) represents a relabelling.
          - A dictionary which is missing i and ~i (for some i) represents an isometry back to this triangulation.
          - None represents the identity isometry.
@@ -1214,6 +1484,11 @@ class Triangulation(object):
                         h = self.encode_flip(item)
                     else:
                         h = h.target_triangulation.encode_flip(item) * h
+                elif isinstance(item, tuple):  # Spiral.
+                    if h is None:
+                        h = flipper.kernel.Spiral(self, self, item[0], item[1]).encode()
+                    else:
+                        h = flipper.kernel.Spiral(h.target_triangulation, h.target_triangulation, item[0], item[1]).encode() * h
                 elif isinstance(item, dict):  # Isometry.
                     if h is None:
                         h = self.encode_relabel_edges(item)
@@ -0,0 +1,75 @@
+
+import unittest
+
+import flipper
+from flipper.kernel.decorators import memoize
+
+class Counter(object):
+    def __init__(self):
+        self.calls = 0
+    
+    @memoize(maxsize=2)
+    def square(self, n, offset=0):
+        self.calls += 1
+        if n < 0:
+            raise flipper.AssumptionError('Negative.')
+        if n != int(n):
+            raise ValueError('Not an integer.')
+        return n * n + offset
+    
+    @memoize
+    def total(self, values):
+        self.calls += 1
+        return sum(values)
+
+class TestMemoize(unittest.TestCase):
+    def test_memoize(self):
+        counter = Counter()
+        self.assertEqual(counter.square(3), 9)
+        self.assertEqual(counter.square(3, 0), 9)
+        self.assertEqual(counter.square(n=3, offset=0), 9)
+        self.assertEqual(counter.calls, 1)
+        self.assertEqual(counter.square(3, offset=1), 10)
+        self.assertEqual(counter.calls, 2)
+        
+        with self.assertRaises(flipper.AssumptionError):
+            counter.square(-1)
+        with self.assertRaises(flipper.AssumptionError):
+            counter.square(-1)
+        self.assertEqual(counter.calls, 3)
+        
+        # At most two results are kept so square(3) has now been evicted.
+        self.assertEqual(counter.square(3), 9)
+        self.assertEqual(counter.calls, 4)
+        self.assertGreater(Counter.square.hits, 0)
+        self.assertGreater(Counter.square.misses, 0)
+    
+    def test_transient_errors(self):
+        counter = Counter()
+        # Only AssumptionErrors are stored, other errors are raised again on every call.
+        with self.assertRaises(ValueError):
+            counter.square(0.5)
+        with self.assertRaises(ValueError):
+            counter.square(0.5)
+        self.assertEqual(counter.calls, 2)
+    
+    def test_unhashable(self):
+        counter = Counter()
+        self.assertEqual(counter.total([1, 2]), 3)  # Not cached.
+        self.assertEqual(counter.total([1, 2]), 3)
+        self.assertEqual(counter.calls, 2)
+        self.assertEqual(counter.total((1, 2)), 3)
+        self.assertEqual(counter.total((1, 2)), 3)
+        self.assertEqual(counter.calls, 3)
+    
+    def test_least_recently_used(self):
+        counter = Counter()
+        counter.square(3)
+        counter.square(4)
+        counter.square(3)  # Now square(4) is the least recently used.
+        counter.square(5)
+        self.assertEqual(counter.calls, 3)
+        counter.square(3)
+        self.assertEqual(counter.calls, 3)
+        counter.square(4)
+        self.assertEqual(counter.calls, 4)
@@ -1,5 +1,11 @@
 
+import gc
+import os
+import pickle
+import shutil
+import tempfile
 import unittest
+import weakref
 
 import flipper
 
@@ -82,4 +88,183 @@ class TestEncoding(unittest.TestCase):
         for surface, word, nt_type in examples:
             h = flipper.load(surface).mapping_class(word)
             self.assertEqual(h.canonical(), h.canonical().canonical())
+    
+    def test_compile(self):
+        examples = [
+            ('S_1_1', 'aB'),
+            ('S_1_2', 'aCBACBacbaccbAaAcAaBBcCcBBcCaBaaaABBabBcaBbCBCbaaa'),
+            ('S_2_1', 'aaabcd'),
+            ('SB_4', 's_0S_1s_2S_3s_1S_2'),
+            ]
+        
+        for surface, word in examples:
+            S = flipper.load(surface)
+            h = S.mapping_class(word)
+            for curve in S.triangulation.key_curves():
+                geometric, algebraic = curve.geometric, curve.algebraic
+                for item in reversed(h.sequence):
+                    geometric, algebraic = item.apply_geometric(geometric), item.apply_algebraic(algebraic)
+                image = h(curve)
+                self.assertEqual(image.geometric, geometric)
+                self.assertEqual(image.algebraic, algebraic)
+    
+    def test_apply_many(self):
+        examples = [
+            ('S_1_1', 'aB'),
+            ('S_1_2', 'abC'),
+            ('S_2_1', 'aaabcd'),
+            ('SB_4', 's_0S_1s_2S_3s_1S_2'),
+            ]
+        
+        for surface, word in examples:
+            S = flipper.load(surface)
+            h = S.mapping_class(word)
+            curves = S.triangulation.key_curves()
+            self.assertEqual(h.apply_many(curves), [h(curve) for curve in curves])
+            self.assertEqual(h.apply_many([]), [])
+    
+    def test_applied_geometric(self):
+        def applied_geometric(h, lamination):
+            As = flipper.kernel.id_matrix(h.zeta)
+            Cs = flipper.kernel.zero_matrix(h.zeta, 1)
+            for item in reversed(h.sequence):
+                As, C = item.applied_geometric(lamination, As)
+                Cs = Cs.join(C)
+                lamination = item(lamination)
+            return As, Cs
+        
+        examples = [
+            ('S_1_1', 'aB', 1),
+            ('S_1_1', 'aB', 70),  # Large enough to overflow int64.
+            ('S_2_1', 'abcdeF', 3),
+            ('SB_4', 's_0S_1s_2S_3s_1S_2', 1),
+            ]
+        
+        for surface, word, power in examples:
+            S = flipper.load(surface)
+            h = S.mapping_class(word)**power
+            for curve in S.triangulation.key_curves():
+                self.assertEqual(h.applied_geometric(curve), applied_geometric(h, curve))
+        
+        # Splitting sequences contain LinearTransformations which change the number of edges.
+        S = flipper.load('S_1_2')
+        h = S.mapping_class('aCBACBacbaccbAaAcAaBBcCcBBcCaBaaaABBabBcaBbCBCbaaa')
+        h = h.splitting_sequence().preperiodic * h
+        for curve in S.triangulation.key_curves():
+            self.assertEqual(h.applied_geometric(curve), applied_geometric(h, curve))
+    
+    def test_apply_many_large(self):
+        S = flipper.load('S_5_1')
+        h = S.mapping_class('aBcDeFgHiJkL')
+        curves = S.triangulation.key_curves()
+        for k in [1, 25]:  # Large enough to overflow int64.
+            self.assertEqual((h**k).apply_many(curves), [(h**k)(curve) for curve in curves])
+    
+    def test_pl_action(self):
+        examples = [
+            ('S_1_1', 'aBab'),
+            ('S_1_2', 'abC'),
+            ]
+        
+        for surface, word in examples:
+            S = flipper.load(surface)
+            h = S.mapping_class(word)
+            cells = list(h.pl_action())
+            self.assertLess(len(cells), 2**h.flip_length())
+            for curve in S.triangulation.key_curves():
+                image = h(curve).geometric
+                self.assertTrue(any(Cs.nonnegative_image(curve.geometric) and As(curve.geometric) == image for As, Cs in cells))
+    
+    def test_persistent_cache(self):
+        directory = tempfile.mkdtemp()
+        try:
+            path = os.path.join(directory, 'cache.sqlite')
+            flipper.kernel.set_persistent_cache(path)
+            for _ in range(2):
+                S = flipper.load('S_1_2')  # Reload so that nothing is cached in memory.
+                self.assertEqual(S.mapping_class('aB').nielsen_thurston_type(), NT_TYPE_REDUCIBLE)
+                self.assertEqual(S.mapping_class('abC').nielsen_thurston_type(), NT_TYPE_PSEUDO_ANOSOV)
+                self.assertEqual(S.mapping_class('abC').canonical(), S.mapping_class('abC').canonical().canonical())
+            cache = flipper.kernel.get_persistent_cache()
+            self.assertGreater(cache.hits, 0)
+            
+            # Only the least recently used entries are evicted, even if their use has not been written yet.
+            cache.clear()
+            cache['a'], cache['b'] = 'a', 'b'
+            self.assertEqual(cache['a'], 'a')
+            cache.max_size = cache.size() + 1
+            cache['c'] = 'c'
+            self.assertNotIn('b', cache)
+            self.assertIn('a', cache)
+            self.assertIn('c', cache)
+            
+            # A forked process opens its own connection.
+            if hasattr(os, 'fork'):
+                connection = cache.connection
+                pid = os.fork()
+                if pid == 0:
+                    try:
+                        os._exit(0 if cache['a'] == 'a' and cache.connection is not connection else 1)
+                    finally:
+                        os._exit(1)
+                self.assertEqual(os.waitpid(pid, 0)[1], 0)
+                self.assertIs(cache.connection, connection)
+            
+            cache.max_size = 1  # Evict everything.
+            cache['key'] = 'value'
+            self.assertEqual(len(cache), 0)
+            cache.close()
+        finally:
+            flipper.kernel.set_persistent_cache(None)
+            shutil.rmtree(directory)
+    
+    def test_compress(self):
+        # Nothing else refers to this surface, so the triangulations of h are only kept alive by h.
+        h = flipper.load('S_1_2').mapping_class('aCBACBacbaccbAaAcAaBBcCcBBcCaBaaaABBabBcaBbCBCbaaa')
+        T = h.source_triangulation
+        images = [h(curve) for curve in T.key_curves()]
+        sequence = str(h.sequence)
+        intermediates = [weakref.ref(item.target_triangulation) for item in h.sequence[1:] if item.target_triangulation is not T]
+        
+        h.compress()
+        gc.collect()
+        self.assertTrue(all(intermediate() is None for intermediate in intermediates))
+        self.assertEqual([h(curve) for curve in T.key_curves()], images)
+        self.assertEqual(str(h.sequence), sequence)
+        self.assertEqual(len(h), len(h.sequence))
+        self.assertEqual(pickle.loads(pickle.dumps(h)), h)
+        self.assertEqual(h.inverse() * h, T.id_encoding())
+        self.assertEqual(h.nielsen_thurston_type(), NT_TYPE_PSEUDO_ANOSOV)
+    
+    def test_composition(self):
+        S = flipper.load('S_1_2')
+        f, g = S.mapping_class('aB'), S.mapping_class('abC')
+        h = f
+        for _ in range(1999):  # Deep enough to break a recursive implementation.
+            h = h * f
+        self.assertEqual(len(h), 2000 * len(f))
+        self.assertEqual(h.flip_length(), 2000 * f.flip_length())
+        self.assertEqual(h.sequence, f.sequence * 2000)
+        
+        for k in [1, 2, 5, 12]:
+            self.assertEqual(len(g**k), k * len(g))
+            self.assertEqual((g**k).sequence, g.sequence * k)
+            self.assertEqual(g**k, g**(k-1) * g)
+            self.assertEqual(str(g**k), '(abC)^%d' % k)
+    
+    def test_simplify(self):
+        examples = [
+            ('S_1_2', 'aA', 0),
+            ('S_1_2', 'aBcCbA', 0),
+            ('S_1_2', 'aCBACBacbaccbAaAcAaBBcCcBBcCaBaaaABBabBcaBbCBCbaaa', 78),
+            ('S_2_1', 'aaabcd', 38),
+            ('S_2_1', 'abcdeF', 48),
+            ]
+        
+        for surface, word, flip_length in examples:
+            h = flipper.load(surface).mapping_class(word)
+            g = h.simplify()
+            self.assertEqual(g, h)
+            self.assertEqual(g.flip_length(), flip_length)
+            self.assertEqual(g.nielsen_thurston_type(), h.nielsen_thurston_type())
 
@@ -1,8 +1,15 @@
 
+import os
 import unittest
 
 import flipper
 
+class CrashingEquippedTriangulation(flipper.kernel.EquippedTriangulation):
+    def classify(self, word, timeout=None):
+        if word == 'crash':
+            os._exit(1)  # Kill the process, as running out of memory would.
+        return super(CrashingEquippedTriangulation, self).classify(word, timeout)
+
 class TestEquippedTriangulation(unittest.TestCase):
     def test_random_word(self):
         S = flipper.load('S_1_2')
@@ -14,4 +21,52 @@ class TestEquippedTriangulation(unittest.TestCase):
     def test_composition(self):
         S = flipper.load('S_1_2')
         self.assertEqual(S.mapping_class('abababababab'), S.mapping_class('xx'))
-
+    
+    def test_classify_many(self):
+        S = flipper.load('S_1_2')
+        words = ['aB', 'abC', 'bbaCBAaBabcABB', 'Q', 'abC']
+        expected = [S.classify(word) for word in words]
+        self.assertEqual([classification.nielsen_thurston_type for classification in expected], ['Reducible', 'Pseudo-Anosov', 'Reducible', None, 'Pseudo-Anosov'])
+        self.assertIsNotNone(expected[3].error)  # 'Q' is not a valid word.
+        
+        self.assertEqual(list(S.classify_many(words)), expected)
+        self.assertEqual(list(S.classify_many(words, cores=2, chunksize=2)), expected)
+        self.assertEqual(sorted(map(repr, S.classify_many(words, cores=2, ordered=False))), sorted(map(repr, expected)))
+        
+        timed_out = S.classify('aCBACBacbaccbAaAcAaBBcCcBBcCaBaaaABBabBcaBbCBCbaaa' * 3, timeout=0.01)
+        self.assertIsNone(timed_out.nielsen_thurston_type)
+        self.assertIn('AbortError', timed_out.error)
+    
+    def test_classify_after_timeout(self):
+        expected = flipper.load('S_1_2').classify('abC')
+        S = flipper.load('S_1_2')
+        # Interrupt the classification at various points, none of which should affect later ones.
+        self.assertIn('AbortError', S.classify('abC', timeout=0.000001).error)
+        for timeout in [0.0001, 0.001, 0.003, 0.01]:
+            S.classify('abC', timeout=timeout)
+        self.assertEqual(S.classify('abC'), expected)
+        self.assertEqual(list(S.classify_many(['abC'], cores=2)), [expected])
+    
+    def test_classify_many_crash(self):
+        S = flipper.load('S_1_2')
+        C = CrashingEquippedTriangulation(S.triangulation, S.laminations, S.pos_mapping_classes)
+        words = ['aB', 'crash', 'abC', 'crash', 'aB', 'abC']
+        expected = dict((word, S.classify(word)) for word in set(words) if word != 'crash')
+        for retries in [0, 1, 2]:
+            classifications = list(C.classify_many(words, cores=2, retries=retries, chunksize=2))
+            self.assertEqual([classification.word for classification in classifications], words)
+            for classification in classifications:
+                if classification.word == 'crash' or classification.error is not None:
+                    self.assertIn('BrokenProcessPool', classification.error)  # Words running alongside a crash may also fail.
+                else:
+                    self.assertEqual(classification, expected[classification.word])
+    
+    def test_all_words_cores(self):
+        S = flipper.load('S_1_2')
+        for equivalence in ['bundle', 'none']:
+            words = list(S.all_words(4, equivalence=equivalence))
+            self.assertEqual(list(S.all_words(4, equivalence=equivalence, cores=2, budget=10, ordered=True)), words)
+            self.assertEqual(sorted(S.all_words(4, equivalence=equivalence, cores=3, budget=3)), sorted(words))
+        
+        words = list(S.all_words(2))
+        self.assertEqual([h.package() for h in S.all_mapping_classes(2, cores=2, budget=2, ordered=True)], [S.mapping_class(word).package() for word in words])
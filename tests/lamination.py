@@ -1,4 +1,7 @@
 
+import os
+import shutil
+import tempfile
 import unittest
 
 import flipper
@@ -26,4 +29,115 @@ class TestLamination(unittest.TestCase):
                 mapping_class.invariant_lamination()
         except flipper.AssumptionError:
             pass  # mapping_class is not pseudo-Anosov.
+    
+    def test_encode_twist(self):
+        for surface in ['S_1_1', 'S_1_2', 'S_2_1']:
+            S = flipper.load(surface)
+            curves = S.triangulation.key_curves()
+            for name, lamination in sorted(S.laminations.items()):
+                if not lamination.is_twistable(): continue  # Some are half-twistable instead.
+                for k in [2, 5, -3]:
+                    h = lamination.encode_twist(k)  # This uses a Spiral.
+                    g = lamination.encode_twist(1 if k > 0 else -1)**abs(k)
+                    self.assertEqual(h, g)
+                    self.assertLessEqual(h.flip_length(), g.flip_length())
+                    for curve in curves:
+                        As, Cs = h.applied_geometric(curve)
+                        self.assertEqual(As(curve.geometric), g(curve).geometric)
+                        self.assertTrue(Cs.nonnegative_image(curve.geometric))
+                        if surface == 'S_1_1':  # Enumerating all cells is slow on larger surfaces.
+                            self.assertTrue(any(Cs.nonnegative_image(curve.geometric) and As(curve.geometric) == h(curve).geometric for As, Cs in h.pl_action()))
+                self.assertEqual(S.triangulation.encode(lamination.encode_twist(3).package()), lamination.encode_twist(3))
+        
+        S = flipper.load('S_1_1')
+        h = S.laminations['a'].encode_twist(5) * S.laminations['b'].encode_twist(-1)
+        self.assertEqual(h.bundle(veering=False).triangulation3.snappy_string(), S.mapping_class('aaaaaB').bundle(veering=False).triangulation3.snappy_string())
+    
+    def test_projective_hash(self):
+        examples = [
+            ('S_1_2', 'abC'),
+            ('S_2_1', 'aaabcd'),
+            ]
+        
+        for surface, word in examples:
+            h = flipper.load(surface).mapping_class(word)
+            dilatation, lamination = h.pml_fixedpoint()
+            for image in [lamination, h(lamination), lamination * 3, lamination * dilatation]:
+                self.assertEqual(image.projective_hash(), lamination.projective_hash())
+            
+            for precision in [lamination.hash_precision(), flipper.kernel.lamination.HASH_DENOMINATOR]:
+                w = lamination.weight()
+                L = [x * 10**precision // w for x in lamination]  # Exactly.
+                self.assertEqual(lamination.projective_hash(precision), tuple(sorted(min(triple[i:] + triple[:i] for i in range(3)) for triple in [tuple(L[edge.index] for edge in triangle) for triangle in lamination.triangulation])))
+            
+            search = flipper.kernel.SplittingSearch(lamination, dilatation)
+            search.run()
+            self.assertEqual(search.num_collisions, 0)
+    
+    def test_all_projective_isometries(self):
+        def all_projective_isometries(lamination, other):
+            return [isometry for isometry in lamination.triangulation.isometries_to(other.triangulation) if other.projectively_equal(isometry.encode()(lamination))]
+        
+        examples = [
+            ('S_1_1', 'aB'),
+            ('S_1_2', 'abC'),
+            ('S_2_1', 'abcdeF'),
+            ]
+        
+        for surface, word in examples:
+            S = flipper.load(surface)
+            h = S.mapping_class(word)
+            dilatation, lamination = h.pml_fixedpoint()
+            laminations = [lamination, h(lamination), lamination * 3, lamination.splitting_sequences(dilatation).lamination] + S.triangulation.key_curves()
+            for x in laminations:
+                for y in laminations:
+                    expected = all_projective_isometries(x, y)
+                    self.assertEqual([isometry.label_map for isometry in x.all_projective_isometries(y)], [isometry.label_map for isometry in expected])
+                    if expected:
+                        self.assertEqual(x.fingerprint(), y.fingerprint())
+    
+    def test_splitting_search(self):
+        h = flipper.load('S_1_2').mapping_class('aCBACBacbaccbAaAcAaBBcCcBBcCaBaaaABBabBcaBbCBCbaaa')
+        dilatation, lamination = h.pml_fixedpoint()
+        expected = lamination.splitting_sequences(dilatation)
+        
+        directory = tempfile.mkdtemp()
+        try:
+            path = os.path.join(directory, 'search.pickle')
+            search = flipper.kernel.SplittingSearch(lamination, dilatation)
+            self.assertIsNone(search.run(time_limit=0, checkpoint=path))  # Stops after a single step.
+            weight = search.weight()
+            while True:
+                search = flipper.kernel.SplittingSearch.load(path)
+                result = search.run(time_limit=0, checkpoint=path)
+                if result is not None: break
+                self.assertLess(search.weight(), weight)
+                weight = search.weight()
+        finally:
+            shutil.rmtree(directory)
+        
+        self.assertEqual(search.num_flips, expected.encoding.flip_length())
+        self.assertEqual(result.index, expected.index)
+        self.assertEqual(str(result.encoding.sequence), str(expected.encoding.sequence))
+    
+    def test_splitting_prepass(self):
+        examples = [
+            ('S_1_2', 'abC'),
+            ('S_2_1', 'aaabcd'),
+            ('S_2_1', 'abcdeF'),
+            ]
+        
+        for surface, word in examples:
+            h = flipper.load(surface).mapping_class(word)
+            dilatation, lamination = h.pml_fixedpoint()
+            expected = flipper.kernel.SplittingSearch(lamination, dilatation).run()
+            search = flipper.kernel.SplittingSearch(lamination, dilatation, prepass=True)
+            self.assertGreater(search.window, 0)
+            
+            # Also check that the search recovers from a window that starts too late.
+            late = flipper.kernel.SplittingSearch(lamination, dilatation)
+            late.reset(search.window + 2)
+            for result in [search.run(), late.run()]:
+                self.assertEqual(result.index, expected.index)
+                self.assertEqual(str(result.encoding.sequence), str(expected.encoding.sequence))
 
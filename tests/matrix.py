@@ -13,4 +13,28 @@ class TestMatrix(unittest.TestCase):
     def test_powers(self):
         M = flipper.kernel.Matrix([[2, 1], [1, 1]])
         self.assertEqual((M**2)**3, (M**3)**2)  # Check that powers are associative.
-
+    
+    def test_interior_point(self):
+        M = flipper.kernel.Matrix([[1, -1], [0, 1], [0, 0]])
+        v = M.interior_point()
+        self.assertTrue(all(flipper.kernel.matrix.dot(row, v) > 0 for row in M if any(row)))
+        
+        self.assertIsNone(flipper.kernel.Matrix([[1, -1], [-2, 2]]).interior_point())
+        self.assertIsNone(flipper.kernel.Matrix([[1, 0], [0, 1], [-1, -1]]).interior_point())
+        
+        examples = [
+            [[-1]],
+            [[-3], [-6]],
+            [[2], [0]],
+            [[-2, 0], [0, 3], [1, 1]],
+            [[-4, 2], [1, 1], [0, 5]],
+            ]
+        for rows in examples:
+            M = flipper.kernel.Matrix(rows)
+            v = M.interior_point()
+            self.assertIsNotNone(v)
+            self.assertTrue(all(flipper.kernel.matrix.dot(row, v) > 0 for row in M if any(row)))
+        
+        self.assertIsNone(flipper.kernel.Matrix([[1], [-1]]).interior_point())
+        self.assertIsNone(flipper.kernel.Matrix([[3], [-2]]).interior_point())
+        self.assertIsNone(flipper.kernel.Matrix([[-4, 2], [2, -1], [0, 5]]).interior_point())
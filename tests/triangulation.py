@@ -24,4 +24,106 @@ class TestTriangulation(unittest.TestCase):
             T2 = flipper.triangulation_from_iso_sig(T.iso_sig())
             self.assertTrue(T.is_isometric_to(T2))
             self.assertEqual(T.iso_sig(), T2.iso_sig())
-
+    
+    def test_flip_edge(self):
+        for surface in ['S_0_4', 'S_1_1', 'S_1_2', 'S_2_1', 'E_12']:
+            T = flipper.load(surface).triangulation
+            for i in range(3 * T.zeta):
+                edge_label = T.flippable_edges()[i % len(T.flippable_edges())]
+                T = T.flip_edge(edge_label if i % 2 else ~edge_label)
+                T2 = flipper.kernel.Triangulation([flipper.kernel.Triangle(list(triangle.edges)) for triangle in T])
+                self.assertEqual(T, T2)
+                self.assertEqual([[corner.label for corner in corner_class] for corner_class in T.corner_classes], [[corner.label for corner in corner_class] for corner_class in T2.corner_classes])
+                self.assertEqual([corner.label for corner in T.corners], [corner.label for corner in T2.corners])
+                self.assertEqual(T.key_curves(), T2.key_curves())
+    
+    def test_flip_edge_shared(self):
+        T = flipper.load('S_1_2').triangulation
+        for edge_label in T.flippable_edges():
+            T2 = T.flip_edge(edge_label)
+            self.assertIs(T.flip_edge(edge_label), T2)
+            self.assertEqual(T2.flip_edge(~edge_label), T)
+            self.assertIs(T2.flip_edge(~edge_label).flip_edge(edge_label), T2)
+    
+    def test_compress(self):
+        for surface in ['S_1_2', 'S_2_1', 'E_12', 'SB_6']:
+            T = flipper.load(surface).triangulation
+            package, key_curves = T.package(), T.key_curves()
+            T.compress()
+            self.assertNotIn('edges', T.__dict__)
+            self.assertEqual(T.package(), package)
+            self.assertEqual(T.key_curves(), key_curves)
+            self.assertEqual(T.flip_edge(T.flippable_edges()[0]).flip_edge(~T.flippable_edges()[0]), T)
+    
+    def test_key_curves_cached(self):
+        for surface in ['S_1_2', 'S_2_1']:
+            T = flipper.load(surface).triangulation
+            curves = T.key_curves()
+            self.assertIs(T.key_curves(), curves)
+            self.assertIs(T.homology_basis(), T.homology_basis())
+            self.assertEqual(flipper.load(surface).triangulation.key_curves(), curves)  # A new triangulation computes them again.
+            
+            edge_label = T.flippable_edges()[0]
+            T2 = T.flip_edge(edge_label)
+            self.assertIs(T2.flip_edge(~edge_label).flip_edge(edge_label).key_curves(), T2.key_curves())
+    
+    def test_homology_basis(self):
+        for surface in ['S_1_2', 'S_2_1', 'S_3_1', 'SB_6']:
+            T = flipper.load(surface).triangulation
+            tree, dual_tree = T.tree_and_dual_tree()
+            self.assertEqual(sum(tree), len(T.vertices) - 1)
+            self.assertEqual(sum(dual_tree), len(T.triangles) - 1)
+            self.assertFalse(any(a and b for a, b in zip(tree, dual_tree)))
+            
+            basis = T.homology_basis()
+            self.assertEqual(len(basis), 2 * T.genus)
+            for path in basis:
+                self.assertEqual(len(set(flipper.norm(label) for label in path)), len(path))
+                # Consecutive steps of the path must cross the sides of the same triangle.
+                for label, next_label in zip(path, path[1:] + path[:1]):
+                    self.assertEqual(T.triangle_lookup[label], T.triangle_lookup[~next_label])
+    
+    def test_sig_relabel(self):
+        examples = [flipper.load(surface).triangulation for surface in ['S_0_4', 'S_1_2', 'S_2_1', 'SB_6']]
+        examples.append(flipper.create_triangulation([[0, 1, ~1], [~0, 2, 3], [~2, 4, ~4], [~3, 5, ~5]]))  # Has self-folded triangles.
+        for T in examples:
+            self.assertIs(T.iso_sig(), T.iso_sig())
+            for k in range(1, 4):
+                label_map = dict((i, (i * k + 1) % T.zeta if i % 2 else ~((i * k + 1) % T.zeta)) for i in range(T.zeta))
+                if len(set(flipper.norm(label) for label in label_map.values())) < T.zeta: continue
+                T2 = T.relabel_edges(label_map)
+                self.assertEqual(T.iso_sig(), T2.iso_sig())
+                self.assertEqual(T.iso_sig(preserve_orientation=True), T2.iso_sig(preserve_orientation=True))
+                for i in range(T.zeta):
+                    self.assertEqual(T.iso_sig(skip=[i]), T2.iso_sig(skip=[label_map[i]]))
+    
+    def test_isometries_to(self):
+        for surface in ['S_1_2', 'S_2_1', 'E_12', 'SB_6']:
+            T = flipper.load(surface).triangulation
+            self.assertIs(T.self_isometries(), T.self_isometries())
+            T2 = T.relabel_edges(dict((i, ~((i + 1) % T.zeta)) for i in range(T.zeta)))
+            for other in [T, T2, T.flip_edge(T.flippable_edges()[0])]:
+                isometries = []
+                for label in other.labels:
+                    try:
+                        isometries.append(T.find_isometry(other, {0: label}))
+                    except flipper.AssumptionError:
+                        pass
+                self.assertEqual(sorted(sorted(isometry.label_map.items()) for isometry in T.isometries_to(other)), sorted(sorted(isometry.label_map.items()) for isometry in isometries))
+                for isometry in isometries:
+                    self.assertTrue(all(T.corner_invariants()[label] == other.corner_invariants()[isometry.label_map[label]] for label in T.labels))
+    
+    def test_hash(self):
+        T = flipper.load('S_2_1').triangulation
+        T2 = flipper.kernel.Triangulation([flipper.kernel.Triangle(list(triangle.edges)) for triangle in T])
+        T3 = T.flip_edge(T.flippable_edges()[0])
+        self.assertIsNot(T, T2)
+        self.assertEqual(T, T2)
+        self.assertEqual(hash(T), hash(T2))
+        self.assertNotEqual(T, T3)
+        self.assertNotEqual(T, None)
+        self.assertEqual(T3.flip_edge(~T.flippable_edges()[0]), T)
+        
+        cache = {T: 1, T3: 2}
+        self.assertEqual(cache[T2], 1)
+        self.assertEqual(cache[T3.flip_edge(~T.flippable_edges()[0]).flip_edge(T.flippable_edges()[0])], 2)